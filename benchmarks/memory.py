@@ -0,0 +1,161 @@
+"""
+    Bytes per document for typical schemas
+
+    python benchmarks/memory.py [count]
+
+    Uses tracemalloc when available (python 3.4+), otherwise walks the
+    objects reachable from the documents and sums sys.getsizeof
+"""
+import datetime
+import gc
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dico
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class Flat(dico.Document):
+    id = dico.IntegerField()
+    name = dico.StringField()
+    email = dico.EmailField()
+    active = dico.BooleanField()
+    creation_date = dico.DateTimeField()
+
+
+class Counters(dico.Document):
+    id = dico.IntegerField()
+    values = dico.ListField(dico.IntegerField())
+
+
+class Metrics(dico.Document):
+    id = dico.IntegerField()
+    samples = dico.ListField(dico.IntegerField())
+
+
+class TypedMetrics(dico.Document):
+    id = dico.IntegerField()
+    samples = dico.ListField(dico.IntegerField(), typed=True)
+
+
+class Token(dico.Document):
+    secret = dico.StringField()
+    active = dico.BooleanField()
+
+
+class Nested(dico.Document):
+    id = dico.IntegerField()
+    name = dico.StringField()
+    token = dico.EmbeddedDocumentField(Token)
+    tokens = dico.ListField(dico.EmbeddedDocumentField(Token))
+
+
+NOW = datetime.datetime(2012, 7, 17)
+
+
+def flat(i):
+    return {'id': i, 'name': 'Bob', 'email': 'bob@sponge.com', 'active': True,
+            'creation_date': NOW}
+
+
+def counters(i):
+    return {'id': i, 'values': [1, 2, 3, 4]}
+
+
+def metrics(i):
+    return {'id': i, 'samples': [i * 1000 + n for n in range(100)]}
+
+
+def nested(i):
+    return {'id': i, 'name': 'Bob', 'token': {'secret': 'abc', 'active': True},
+            'tokens': [{'secret': 'abc', 'active': True}, {'secret': 'def', 'active': False}]}
+
+
+def touch(document):
+    """ modify a field so the modification tracking is allocated
+    """
+    document.id = document.id + 1
+
+
+SCHEMAS = [
+    ('flat', Flat, flat),
+    ('counters', Counters, counters),
+    ('nested', Nested, nested),
+    ('metrics', Metrics, metrics),
+    ('typed', TypedMetrics, metrics),
+]
+
+
+def _raw(obj, name):
+    """ read an attribute without triggering Document defaults
+    """
+    try:
+        return object.__getattribute__(obj, name)
+    except AttributeError:
+        return None
+
+
+def _deep_sizeof(objects):
+    """ sum sys.getsizeof of everything reachable from objects
+        classes and fields are not counted, shared objects are counted once
+    """
+    seen = set()
+    size = 0
+    stack = list(objects)
+    while stack:
+        obj = stack.pop()
+        if obj is None or id(obj) in seen or isinstance(obj, (type, dico.BaseField)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        for klass in type(obj).__mro__:
+            slots = klass.__dict__.get('__slots__', ())
+            if isinstance(slots, str):
+                slots = (slots,)
+            stack.extend(_raw(obj, slot) for slot in slots)
+        stack.append(_raw(obj, '__dict__'))
+    return size
+
+
+def measure(build, count):
+    """ return bytes per document built by build()
+    """
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        documents = [build(i) for i in range(count)]
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return (after - before) / float(count)
+    documents = [build(i) for i in range(count)]
+    return _deep_sizeof(documents) / float(count)
+
+
+def main(count=10000):
+    method = 'tracemalloc' if tracemalloc is not None else 'sys.getsizeof walk'
+    print('bytes per document, %d documents, %s' % (count, method))
+    for name, klass, raw in SCHEMAS:
+        loaded = measure(lambda i: klass(**raw(i)), count)
+
+        def modified(i):
+            document = klass(**raw(i))
+            touch(document)
+            return document
+
+        print('%-10s loaded %8.1f  modified %8.1f' % (name, loaded, measure(modified, count)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
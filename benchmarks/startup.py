@@ -0,0 +1,87 @@
+"""
+    Cold start: import time of dico and of a large schema module
+
+    python benchmarks/startup.py [classes] [runs]
+
+    Each run is a new interpreter, the schema module defines classes
+    Document classes with the usual field types, half of them are subclasses
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEADER = '''import dico
+import dico.mongo
+
+
+class Token(dico.Document):
+    secret = dico.StringField(max_length=40)
+    active = dico.BooleanField()
+
+'''
+
+CLASS = '''
+class Model%(i)d(dico.Document):
+    id = dico.mongo.ObjectIdField(required=True, db_name='_id')
+    name = dico.StringField(required=True, max_length=40, aliases=['title'])
+    email = dico.EmailField()
+    url = dico.URLField()
+    count = dico.IntegerField(default=0)
+    ratio = dico.FloatField()
+    created = dico.DateTimeField()
+    tags = dico.ListField(dico.StringField())
+    token = dico.EmbeddedDocumentField(Token)
+    public_fields = ['name', 'url']
+
+
+class Model%(i)dChild(Model%(i)d):
+    pass
+'''
+
+TIMER = '''
+import time
+start = time.time()
+import dico
+imported = time.time()
+import dico.mongo
+mongo = time.time()
+import schema
+end = time.time()
+print('%f %f %f' % (imported - start, mongo - imported, end - mongo))
+'''
+
+
+def write_schema(directory, classes):
+    with open(os.path.join(directory, 'schema.py'), 'w') as schema:
+        schema.write(HEADER)
+        for i in range(classes // 2):
+            schema.write(CLASS % {'i': i})
+
+
+def run(directory):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, directory]),
+               PYTHONDONTWRITEBYTECODE='1')
+    output = subprocess.check_output([sys.executable, '-c', TIMER], env=env)
+    return [float(value) * 1000 for value in output.split()]
+
+
+def main(classes=300, runs=10):
+    directory = tempfile.mkdtemp()
+    try:
+        write_schema(directory, classes)
+        # best of runs, each column on its own
+        best = [min(column) for column in zip(*[run(directory) for i in range(runs)])]
+    finally:
+        shutil.rmtree(directory)
+    print('milliseconds, best of %d runs, %d classes' % (runs, classes))
+    print('import dico        %8.2f' % best[0])
+    print('import dico.mongo  %8.2f' % best[1])
+    print('import schema      %8.2f' % best[2])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
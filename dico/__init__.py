@@ -1,8 +1,37 @@
 import re
+import array
+import codecs
+import copy
 import datetime
+import hashlib
+import json
+import operator
 import socket
+from itertools import islice
 
-URL_REGEX_COMPILED = re.compile(
+
+class LazyRegex(object):
+    """ a regex compiled on first use, keeps import time low
+        match and search are stored in slots once compiled so they are
+        looked up like methods of the compiled pattern
+    """
+    __slots__ = ('_args', '_compiled', 'match', 'search')
+
+    def __init__(self, *args):
+        self._args = args
+        self._compiled = None
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in LazyRegex.__slots__[:2]:
+            raise AttributeError(name)
+        if self._compiled is None:
+            self._compiled = compiled = re.compile(*self._args)
+            self.match = compiled.match
+            self.search = compiled.search
+        return getattr(self._compiled, name)
+
+
+URL_REGEX_COMPILED = LazyRegex(
     r'^https?://'
     r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+[A-Z]{2,6}\.?|'
     r'localhost|'
@@ -11,7 +40,7 @@ URL_REGEX_COMPILED = re.compile(
     r'(?:/?|[/?]\S+)$', re.IGNORECASE
 )
 
-EMAIL_REGEX_COMPILED = re.compile(
+EMAIL_REGEX_COMPILED = LazyRegex(
     # dot-atom
     r"(^[-!#$%&'*+/=?^_`{}|~0-9A-Z]+(\.[-!#$%&'*+/=?^_`{}|~0-9A-Z]+)*"
     # quoted-string
@@ -23,6 +52,25 @@ EMAIL_REGEX_COMPILED = re.compile(
 )
 
 
+# Document._state is a small int: this bit caches a successful validate()
+# the other bits are the modified fields, see Document._field_bits
+_VALID = 1
+# set once a change has been propagated to the parents, the next changes
+# stop there until the document is read again from above (validate,
+# dict_for_*, content_hash) or attached to another parent
+# clearing the modified fields must clear it in the embedded documents too
+_PROPAGATED = 2
+_NO_FIELDS = frozenset()
+# Document classes with _class_watchers: their existing instances can not be
+# walked to clear _PROPAGATED, so changes always propagate up to them
+_watched_classes = set()
+# Document classes with migrations: their embedded instances upgraded
+# by them are written back with the parent
+_migrated_classes = set()
+# key of the modified state in the savepoint of a Document, not a field name
+_SAVEPOINT_STATE = 0
+
+
 class ValidationException(Exception):
     """The field did not pass validation.
     """
@@ -30,13 +78,17 @@ class ValidationException(Exception):
 
 
 class BaseField(object):
-    def __init__(self, default=None, required=False, choices=None, aliases=None):
+    def __init__(self, default=None, required=False, choices=None, aliases=None,
+                 db_name=None):
         """ the BaseField class for all Document's field
+            db_name is the key used in dict_for_save, dict_for_modified_fields
+            and accepted at construction
         """
         self.default = default
         self.is_required = required
         self.choices = choices
         self.aliases = aliases
+        self.db_name = db_name
 
     def _register_document(self, document, field_name):
         self.field_name = field_name
@@ -47,12 +99,43 @@ class BaseField(object):
 
     def _changed(self, instance):
         """ notify parent's document for changes """
-        instance._modified_fields.add(self.field_name)
-        instance._is_valid = False
-        # called recursively
-        if instance._parent:
+        extras = instance._extras
+        # watchers see the document before the change
+        if extras is not None and extras.watchers is not None:
+            for watcher in extras.watchers:
+                watcher._document_changed(instance, self.field_name)
+        for watcher in instance._class_watchers:
+            watcher._document_changed(instance, self.field_name)
+        if extras is not None:
+            snapshot = extras.snapshot
+            if snapshot is not None:
+                loaded = snapshot.get(self.field_name)
+                # copy on write: freeze the loaded value before its first change
+                if isinstance(loaded, (list, array.array, Document)):
+                    snapshot[self.field_name] = _freeze(loaded)
+            savepoint = extras.savepoint
+            if savepoint is not None and self.field_name not in savepoint:
+                savepoint[self.field_name] = _save(getattr(instance, self.field_name))
+            extras.version += 1
+            cache = extras.cache
+            if cache is not None:
+                # forget the content_hash digests of this field
+                cache.pop(self.field_name, None)
+                # and the computed properties depending on it
+                for name in _computed_dependents(instance.__class__).get(self.field_name, ()):
+                    cache.pop(name, None)
+        state = instance._state
+        # called recursively, unless the parents are already marked
+        # the parents save the document as it is before the change too
+        if instance._parent and (not state & _PROPAGATED or
+                                 _watched_classes and _has_watched_parent(instance)):
             field = instance._parent_field
-            field._changed(instance._parent)
+            field._child_changed(instance._parent, instance)
+        instance._state = (state | instance._field_bits[self.field_name] | _PROPAGATED) & ~_VALID
+
+    def _child_changed(self, instance, child):
+        """ notify for changes inside the document child held by this field """
+        self._changed(instance)
 
 
 class EmbeddedDocumentField(BaseField):
@@ -69,9 +152,11 @@ class EmbeddedDocumentField(BaseField):
             and set the parent
         """
         if isinstance(value, dict):
-            value = self.field_type(parent=instance, parent_field=self, **value)
+            value = self.field_type.from_dict(value, instance, self)
         if isinstance(value, self.field_type):
+            value._parent = instance
             value._parent_field = self
+            value._state &= ~_PROPAGATED
         return value
 
     def _validate(self, value):
@@ -85,10 +170,15 @@ class NotifyParentList(list):
     """
         A minimal list subclass that will notify for modification to the parent
         for special case like parent.obj.append
+        it also keeps the length of the prefix known valid
+        so ListField only validates new or replaced entries
     """
+    __slots__ = ('_parent', '_field', '_valid_len')
+
     def __init__(self, seq=(), parent=None, field=None):
         self._parent = parent
         self._field = field
+        self._valid_len = 0
         super(NotifyParentList, self).__init__(seq)
 
     def _tag_obj_for_parent_name(self, obj):
@@ -97,6 +187,7 @@ class NotifyParentList(list):
         if isinstance(obj, Document):
             obj._parent = self._parent
             obj._parent_field = self._field
+            obj._state &= ~_PROPAGATED
             return
         try:
             iter(obj)
@@ -106,10 +197,38 @@ class NotifyParentList(list):
             if isinstance(entry, Document):
                 entry._parent = self._parent
                 entry._parent_field = self._field
+                entry._state &= ~_PROPAGATED
 
     def _notify_parents(self):
         self._field._changed(self._parent)
 
+    def _index(self, index):
+        """ return index as a positive position in the list
+        """
+        if index < 0:
+            index += len(self)
+        return max(0, min(index, len(self)))
+
+    def _invalidate_from(self, index):
+        """ entries from index have to be validated again
+        """
+        if index < self._valid_len:
+            self._valid_len = index
+
+    def _removed_at(self, index):
+        """ the remaining entries are still valid, shift the prefix
+        """
+        if index < self._valid_len:
+            self._valid_len -= 1
+
+    def _reordered(self, func, *args, **kwargs):
+        """ call func and keep the list valid only if it was entirely valid
+        """
+        all_valid = self._valid_len == len(self)
+        result = func(*args, **kwargs)
+        self._valid_len = len(self) if all_valid else 0
+        return result
+
     def __add__(self, other):
         self._tag_obj_for_parent_name(other)
         self._notify_parents()
@@ -117,19 +236,29 @@ class NotifyParentList(list):
 
     def __setslice__(self, i, j, seq):
         self._tag_obj_for_parent_name(seq)
+        self._invalidate_from(i)
         self._notify_parents()
         return super(NotifyParentList, self).__setslice__(i, j, seq)
 
     def __delslice__(self, i, j):
+        self._invalidate_from(i)
         self._notify_parents()
         return super(NotifyParentList, self).__delslice__(i, j)
 
     def __setitem__(self, key, value):
         self._tag_obj_for_parent_name(value)
+        if isinstance(key, slice):
+            self._invalidate_from(self._index(key.start or 0) if key.step in (None, 1) else 0)
+        else:
+            self._invalidate_from(self._index(key))
         self._notify_parents()
         return super(NotifyParentList, self).__setitem__(key, value)
 
     def __delitem__(self, key):
+        if isinstance(key, slice):
+            self._invalidate_from(self._index(key.start or 0) if key.step in (None, 1) else 0)
+        else:
+            self._removed_at(self._index(key))
         self._notify_parents()
         return super(NotifyParentList, self).__delitem__(key)
 
@@ -139,11 +268,14 @@ class NotifyParentList(list):
         return super(NotifyParentList, self).append(p_object)
 
     def remove(self, value):
+        index = self.index(value)
+        self._removed_at(index)
         self._notify_parents()
-        return super(NotifyParentList, self).remove(value)
+        return super(NotifyParentList, self).__delitem__(index)
 
     def insert(self, index, p_object):
         self._tag_obj_for_parent_name(p_object)
+        self._invalidate_from(self._index(index))
         self._notify_parents()
         return super(NotifyParentList, self).insert(index, p_object)
 
@@ -152,17 +284,189 @@ class NotifyParentList(list):
         self._notify_parents()
         return super(NotifyParentList, self).extend(iterable)
 
-    def pop(self, index=None):
-        if index is None:
-            if super(NotifyParentList, self).pop():
-                self._notify_parents()
+    def pop(self, index=-1):
+        if self:
+            self._removed_at(self._index(index))
+            self._notify_parents()
+        return super(NotifyParentList, self).pop(index)
+
+    def __iadd__(self, other):
+        self._tag_obj_for_parent_name(other)
+        self._notify_parents()
+        return super(NotifyParentList, self).__iadd__(other)
+
+    def __imul__(self, n):
+        self._notify_parents()
+        return self._reordered(super(NotifyParentList, self).__imul__, n)
+
+    def sort(self, *args, **kwargs):
+        self._notify_parents()
+        return self._reordered(super(NotifyParentList, self).sort, *args, **kwargs)
+
+    def reverse(self):
+        self._notify_parents()
+        return self._reordered(super(NotifyParentList, self).reverse)
+
+
+def _bulk(typecode, seq):
+    """ return seq in a form array.array loads in bulk
+        numpy arrays of a compatible kind are converted to bytes without a python loop
+    """
+    kind = getattr(getattr(seq, 'dtype', None), 'kind', None)
+    if kind is not None and (kind in 'biu' or (kind == 'f' and typecode == 'd')):
+        converted = seq.astype(typecode)
+        return getattr(converted, 'tobytes', getattr(converted, 'tostring', None))()
+    return seq
+
+
+class NotifyParentArray(array.array):
+    """
+        NotifyParentList counterpart for typed ListField, backed by an array.array
+        entries are type checked in bulk by array itself at insert time
+    """
+    __slots__ = ('_parent', '_field')
+
+    def __new__(cls, typecode, seq=(), parent=None, field=None):
+        return super(NotifyParentArray, cls).__new__(cls, typecode, _bulk(typecode, seq))
+
+    def __init__(self, typecode, seq=(), parent=None, field=None):
+        self._parent = parent
+        self._field = field
+
+    def _notify_parents(self):
+        self._field._changed(self._parent)
+
+    def _checked(self, values):
+        """ return values in an array of our typecode
+            raise like array does for values it does not accept,
+            before the parent is notified
+        """
+        return array.array(self.typecode, values)
+
+    def _check_array(self, value):
+        if not isinstance(value, array.array) or value.typecode != self.typecode:
+            raise TypeError('can only assign array of typecode %s' % self.typecode)
+
+    def _load(self, method, *args):
+        """ call the array method reading entries on a new array, then add them
+        """
+        loaded = array.array(self.typecode)
+        error = None
+        try:
+            getattr(loaded, method)(*args)
+        except EOFError as e:
+            # fromfile keeps the entries read before the end of file
+            error = e
+        if loaded:
+            self._notify_parents()
+            super(NotifyParentArray, self).extend(loaded)
+        if error is not None:
+            raise error
+
+    def __setslice__(self, i, j, seq):
+        self._check_array(seq)
+        self._notify_parents()
+        return super(NotifyParentArray, self).__setslice__(i, j, seq)
+
+    def __delslice__(self, i, j):
+        self._notify_parents()
+        return super(NotifyParentArray, self).__delslice__(i, j)
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            self._check_array(value)
         else:
-            if super(NotifyParentList, self).pop(index):
-                self._notify_parents()
+            self[key]
+            self._checked((value,))
+        self._notify_parents()
+        return super(NotifyParentArray, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self[key]
+        self._notify_parents()
+        return super(NotifyParentArray, self).__delitem__(key)
+
+    def append(self, p_object):
+        self._checked((p_object,))
+        self._notify_parents()
+        return super(NotifyParentArray, self).append(p_object)
+
+    def remove(self, value):
+        index = self.index(value)
+        self._notify_parents()
+        return super(NotifyParentArray, self).__delitem__(index)
+
+    def insert(self, index, p_object):
+        self._checked((p_object,))
+        self._notify_parents()
+        return super(NotifyParentArray, self).insert(index, p_object)
+
+    def extend(self, iterable):
+        iterable = self._checked(_bulk(self.typecode, iterable))
+        self._notify_parents()
+        return super(NotifyParentArray, self).extend(iterable)
+
+    def fromlist(self, seq):
+        if not isinstance(seq, list):
+            raise TypeError('arg must be list')
+        values = self._checked(seq)
+        self._notify_parents()
+        return super(NotifyParentArray, self).extend(values)
+
+    def fromstring(self, string):
+        self._load('fromstring', string)
+
+    def frombytes(self, string):
+        self._load('frombytes', string)
+
+    def fromfile(self, f, n):
+        self._load('fromfile', f, n)
+
+    def fromunicode(self, string):
+        self._load('fromunicode', string)
+
+    def pop(self, index=-1):
+        if self:
+            self[index]
+            self._notify_parents()
+        return super(NotifyParentArray, self).pop(index)
+
+    def __iadd__(self, other):
+        self._check_array(other)
+        self._notify_parents()
+        return super(NotifyParentArray, self).__iadd__(other)
+
+    def __imul__(self, n):
+        operator.index(n)
+        self._notify_parents()
+        return super(NotifyParentArray, self).__imul__(n)
+
+    def reverse(self):
+        self._notify_parents()
+        return super(NotifyParentArray, self).reverse()
+
+    def byteswap(self):
+        self._notify_parents()
+        return super(NotifyParentArray, self).byteswap()
+
+
+def _invalidate_entry(entries, child):
+    """ validate again the entry holding child, searched in the lists of lists too
+        return False if child is not in entries
+    """
+    for index, entry in enumerate(entries):
+        if entry is child or isinstance(entry, NotifyParentList) and \
+                _invalidate_entry(entry, child):
+            entries._invalidate_from(index)
+            return True
+    return False
 
 
 class ListField(BaseField):
-    def __init__(self, subfield, max_length=0, min_length=0, **kwargs):
+    def __init__(self, subfield, max_length=0, min_length=0, typed=False, **kwargs):
+        """ with typed=True an IntegerField or FloatField list is stored
+            in an array.array, see NotifyParentArray
+        """
         self.subfield = subfield
         self.max_length = max_length
         self.min_length = min_length
@@ -172,14 +476,29 @@ class ListField(BaseField):
         if not isinstance(subfield, (BaseField)):
             raise AttributeError('ListField only accepts BaseField subclass')
 
+        self.typecode = None
+        if typed:
+            self.typecode = getattr(subfield, 'typecode', None)
+            if self.typecode is None:
+                raise AttributeError('typed ListField only accepts IntegerField or FloatField')
+
         super(ListField, self).__init__(**kwargs)
 
     def _register_document(self, document, field_name):
         self.subfield._register_document(document, field_name)
         BaseField._register_document(self, document, field_name)
 
+    def _coerce(self, value):
+        """ coerce each entry with the subfield
+        """
+        coerce = getattr(self.subfield, '_coerce', None)
+        if coerce is None or not isinstance(value, (list, tuple)):
+            return value
+        return [coerce(entry) for entry in value]
+
     def _validate(self, value):
-        if not isinstance(value, list):
+        typed = isinstance(value, array.array)
+        if not typed and not isinstance(value, list):
             return False
         if self.max_length != 0:
             if len(value) > self.max_length:
@@ -187,15 +506,47 @@ class ListField(BaseField):
         if self.min_length != 0:
             if len(value) < self.min_length:
                 return False
-        for entry in value:
+        # entries of an array have been type checked when inserted
+        if typed:
+            return value.typecode == self.typecode
+        # lists in a list change without telling this field, they are all
+        # checked, each one only validates its own new entries
+        if not isinstance(value, NotifyParentList) or isinstance(self.subfield, ListField):
+            for entry in value:
+                if not self.subfield._validate(entry):
+                    return False
+            return True
+        # only entries after the prefix known valid are checked
+        start = value._valid_len
+        for index, entry in enumerate(islice(value, start, None), start):
             if not self.subfield._validate(entry):
+                value._valid_len = index
                 return False
+        value._valid_len = len(value)
         return True
 
+    def _child_changed(self, instance, child):
+        """ an entry changed, it has to be validated again
+        """
+        value = getattr(instance, self.field_name)
+        if isinstance(value, NotifyParentList):
+            _invalidate_entry(value, child)
+        self._changed(instance)
+
     def _prepare(self, instance, value):
         """ we set the parent for each element
             and set a NotifyParentList in place of a list
+            or a NotifyParentArray for a typed list
         """
+        if self.typecode is not None and not isinstance(value, (str, unicode)):
+            if isinstance(value, NotifyParentArray) and value.typecode == self.typecode and \
+                    value._field is self and value._parent is instance:
+                return value
+            try:
+                return NotifyParentArray(self.typecode, value, parent=instance, field=self)
+            except (TypeError, ValueError, OverflowError):
+                # keep a list so validate() tells about the bad entries
+                pass
         try:
             iter(value)
         except TypeError:
@@ -206,9 +557,14 @@ class ListField(BaseField):
                 for obj in value:
                     obj = self.subfield._prepare(instance, obj)
                     if obj:
+                        if isinstance(obj, Document):
+                            obj._parent_field = self
                         obj_list.append(obj)
                 value = obj_list
-            if not isinstance(value, NotifyParentList):
+            # a list of another field or document keeps the prefix it validated
+            # and notifies its owner, it is wrapped again
+            if not isinstance(value, NotifyParentList) or value._field is not self or \
+                    value._parent is not instance:
                 value = NotifyParentList(value, parent=instance, field=self)
         return value
 
@@ -270,18 +626,40 @@ class EmailField(StringField):
 
 
 class IntegerField(BaseField):
+    # array.array type for a typed ListField
+    typecode = 'l'
+
     def _validate(self, value):
         if not isinstance(value, (int, long)):
             return False
         return True
 
+    def _coerce(self, value):
+        if isinstance(value, basestring):
+            try:
+                return int(value)
+            except ValueError:
+                pass
+        return value
+
 
 class FloatField(BaseField):
+    # array.array type for a typed ListField
+    typecode = 'd'
+
     def _validate(self, value):
         if not isinstance(value, (float, int)):
             return False
         return True
 
+    def _coerce(self, value):
+        if isinstance(value, basestring):
+            try:
+                return float(value)
+            except ValueError:
+                pass
+        return value
+
 
 class DateTimeField(BaseField):
     def _validate(self, value):
@@ -289,6 +667,82 @@ class DateTimeField(BaseField):
             return False
         return True
 
+    def _coerce(self, value):
+        if isinstance(value, basestring):
+            return _parse_datetime(value)
+        return value
+
+
+ISO_DATETIME_REGEX_COMPILED = LazyRegex(
+    r'(\d{4})-(\d\d)-(\d\d)'
+    r'(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6})\d*)?)?)?'
+    r'(Z|[+-]\d\d(?::?\d\d)?)?$'
+)
+
+
+def _parse_datetime(value):
+    """ return a naive UTC datetime from an ISO 8601 string
+        or value itself if it is not one
+    """
+    match = ISO_DATETIME_REGEX_COMPILED.match(value)
+    if match is None:
+        return value
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    try:
+        parsed = datetime.datetime(int(year), int(month), int(day),
+            int(hour or 0), int(minute or 0), int(second or 0),
+            int(fraction.ljust(6, '0')) if fraction else 0)
+    except ValueError:
+        return value
+    if offset and offset != 'Z':
+        minutes = int(offset[-2:]) if len(offset) > 3 else 0
+        delta = datetime.timedelta(hours=int(offset[1:3]), minutes=minutes)
+        parsed = parsed - delta if offset[0] == '+' else parsed + delta
+    return parsed
+
+
+class ComputedProperty(object):
+    """
+        read only property whose value is cached on the document
+        until one of the fields it depends on changes, see computed()
+    """
+    def __init__(self, function, depends_on):
+        self.function = function
+        self.depends_on = depends_on
+        self.name = function.__name__
+        self.__doc__ = function.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        cache = instance._get_cache()
+        try:
+            return cache[self.name]
+        except KeyError:
+            pass
+        dependents = _computed_dependents(instance.__class__)
+        if any(field_name in dependents for field_name in _document_fields(instance.__class__)):
+            # changes in embedded documents have to reach the document
+            _clear_propagated(instance)
+        value = cache[self.name] = self.function(instance)
+        return value
+
+    def __set__(self, instance, value):
+        raise AttributeError("can't set attribute %s" % self.name)
+
+
+def computed(*depends_on):
+    """ decorator of a method giving a property cached on the document,
+        forgotten when one of the fields depends_on changes
+
+        >>> @computed('firstname', 'name')
+        ... def full_name(self):
+        ...     return self.firstname + ' ' + self.name
+    """
+    def decorator(function):
+        return ComputedProperty(function, depends_on)
+    return decorator
+
 
 class DocumentMetaClass(type):
     def __new__(cls, name, bases, attrs):
@@ -310,32 +764,170 @@ class DocumentMetaClass(type):
         klass = type.__new__(cls, name, bases, newattrs)
 
         if not meta:
+            own_fields = klass._fields
             klass._aliases = []
-            for field_name, field in klass._fields.items():
+            for field_name, field in own_fields.items():
                 field._register_document(klass, field_name)
 
-            for base in bases:
-                if not getattr(base, "_meta", True):
-                    base_fields = base._fields.copy()
-                    base_fields.update(klass._fields)
-                    klass._fields = base_fields
-                    klass._aliases += base._aliases
+            document_bases = [base for base in bases if not getattr(base, "_meta", True)]
+            if not own_fields and len(document_bases) == 1:
+                # no new field: share the read only tables of the base
+                base = document_bases[0]
+                klass._fields = base._fields
+                klass._aliases = base._aliases
+                klass._field_bits = base._field_bits
+                klass._db_names = base._db_names
+            else:
+                if document_bases:
+                    # merged in one pass, the first bases take precedence
+                    fields = {}
+                    for base in reversed(document_bases):
+                        fields.update(base._fields)
+                    fields.update(own_fields)
+                    klass._fields = fields
+                    for base in document_bases:
+                        klass._aliases += base._aliases
+
+                klass._field_bits = dict((field_name, 4 << index)
+                    for index, field_name in enumerate(sorted(klass._fields)))
+                klass._db_names = dict((field_name, field.db_name)
+                    for field_name, field in klass._fields.items()
+                    if field.db_name is not None)
+
+            coerce = klass.coerce
+            if coerce:
+                if coerce is True:
+                    coerce = klass._fields
+                for field_name in coerce:
+                    if field_name not in klass._fields:
+                        raise AttributeError('coerce %s is not a field of %s' %
+                            (field_name, name))
+                klass._coerced = frozenset(field_name for field_name in coerce
+                    if hasattr(klass._fields[field_name], '_coerce'))
+            else:
+                klass._coerced = _NO_FIELDS
+
+            if 'migrations' in attrs or 'schema_version' in attrs or \
+                    'schema_version_field' in attrs:
+                cls._register_migrations(klass, name)
+
+            if klass.discriminator is not None:
+                cls._register_polymorphic(klass, name, attrs)
         return klass
 
+    @staticmethod
+    def _register_migrations(klass, name):
+        """ check the chain of migrations once, __init__ only slices it
+        """
+        if not klass.schema_version:
+            klass._migrations = ()
+            return
+        if klass.schema_version_field not in klass._fields:
+            raise AttributeError('schema_version_field %s is not a field of %s' %
+                (klass.schema_version_field, name))
+        migrations = klass.migrations or {}
+        for version in range(klass.schema_version):
+            if version not in migrations:
+                raise AttributeError('%s has no migration from version %d' % (name, version))
+        klass._migrations = tuple(migrations[version]
+            for version in range(klass.schema_version))
+        _migrated_classes.add(klass)
+
+    @staticmethod
+    def _register_polymorphic(klass, name, attrs):
+        """ the class declaring discriminator holds the registry
+            of its subclasses by discriminator_value, the class name by default
+        """
+        if klass.discriminator not in klass._fields:
+            raise AttributeError('discriminator %s is not a field of %s' %
+                (klass.discriminator, name))
+        if 'discriminator' in attrs:
+            klass._registry = {}
+        klass.discriminator_value = attrs.get('discriminator_value', name)
+        if klass.discriminator_value in klass._registry:
+            raise AttributeError('discriminator_value %s of %s is already used by %s' %
+                (klass.discriminator_value, name,
+                 klass._registry[klass.discriminator_value].__name__))
+        klass._registry[klass.discriminator_value] = klass
+        # the JSON parser accepts the fields of all the registered classes
+        for registered in klass._registry.values():
+            if '_input_fields' in registered.__dict__:
+                del registered._input_fields
+
+
+class _Extras(object):
+    """
+        optional state of a Document, allocated on first use
+        so a plain loaded document only pays for one slot
+    """
+    __slots__ = ('version', 'cache', 'watchers', 'snapshot', 'savepoint', 'shared')
+
+    def __init__(self):
+        # bumped on every modification, including in embedded documents,
+        # from the allocation of the extras: readers allocate them before reading it
+        self.version = 0
+        # dict_for_* results and content_hash digests
+        self.cache = None
+        # objects notified of field changes, see DocumentSet
+        self.watchers = None
+        # values as loaded, frozen on their first change, see BaseField._changed
+        self.snapshot = None
+        # values before their first change since savepoint()
+        self.savepoint = None
+        # {field_name: _Shared holding its value} in a clone, see clone()
+        self.shared = None
+
 
 class Document(object):
 
     __metaclass__ = DocumentMetaClass
-    __slots__ = ('_modified_fields', '_is_valid', '_parent', '_parent_field')
+    __slots__ = ('_state', '_parent', '_parent_field', '_extras')
 
     _meta = True
 
+    # compare modified fields with the values as loaded
+    # so modified_fields() ignores assignments of an equal value
+    track_snapshot = False
+
+    # memoize dict_for_save/public/owner until the next modification
+    cache_dicts = False
+
+    # convert strings to the type of IntegerField, FloatField, DateTimeField,
+    # ObjectIdField and ListField of them before validation
+    # True for all fields or a list of field names
+    coerce = False
+
+    # name of the field telling which subclass to build in from_dict()
+    # the value of each subclass is its discriminator_value, its name by default
+    discriminator = None
+    discriminator_value = None
+
+    # version of the schema, stored in schema_version_field
+    # migrations[version] is a function(values) returning the values of version + 1
+    # the values of an older version are upgraded in __init__, documents
+    # without version are at the current one
+    schema_version = 0
+    schema_version_field = None
+    migrations = None
+
+    # objects notified of field changes of all the instances, see ChangeObserver
+    _class_watchers = ()
+
+    # migrations[version:] upgrades values of version to schema_version
+    _migrations = ()
+
     def __init__(self, parent=None, parent_field=None, **values):
-        self._modified_fields = set()
-        # optimization to avoid double validate() if nothing has changed
-        self._is_valid = False
+        # modified fields and validity as bits, an int is cheaper than a set
+        # and avoids double validate() if nothing has changed
+        self._state = 0
         self._parent = parent
         self._parent_field = parent_field
+        # version, caches, watchers, snapshot... see _Extras
+        self._extras = None
+        snapshot = None
+        if self.track_snapshot:
+            self._extras = _Extras()
+            self._extras.snapshot = snapshot = {}
 
         # TODO: this check should be done during __new__
         for alias, key in self._aliases:
@@ -346,17 +938,73 @@ class Document(object):
                 values[key] = values[alias]
                 del values[alias]
 
+        for key, db_name in self._db_names.items():
+            if db_name in values:
+                if key in values:
+                    raise ValueError("The field %s overrides this db_name %s" %
+                        (key, db_name))
+                values[key] = values.pop(db_name)
+
+        discriminator = self.discriminator
+        if discriminator is not None and values.get(discriminator) is None:
+            values[discriminator] = self.discriminator_value
+
+        upgraded = _NO_FIELDS
+        if self._migrations:
+            version_field = self.schema_version_field
+            version = values.get(version_field)
+            if version is None:
+                values[version_field] = self.schema_version
+            elif version < self.schema_version:
+                values, upgraded = self._migrate(values, version)
+
+        coerced = self._coerced
         for key, field in self._fields.items():
             value = values.get(key, None)
 
             if value is not None:
+                if coerced and key in coerced:
+                    value = field._coerce(value)
                 if hasattr(field, "_prepare"):
                     value = field._prepare(self, value)
                 object.__setattr__(self, key, value)
+                if snapshot is not None:
+                    snapshot[key] = value
+
+        if _migrated_classes:
+            for child in _embedded_documents(self):
+                # an embedded document upgraded by its migrations is written back too
+                if child._migrations and \
+                        child._state & child._field_bits[child.schema_version_field]:
+                    upgraded = set(upgraded)
+                    upgraded.add(child._parent_field.field_name)
+
+        if upgraded:
+            # written back with the next dict_for_modified_fields()
+            for key in upgraded:
+                self._state |= self._field_bits[key]
+                if snapshot is not None:
+                    snapshot.pop(key, None)
+
+    def _migrate(self, values, version):
+        """ return values upgraded from version to schema_version
+            and the set of fields whose value changed
+        """
+        loaded = copy.deepcopy(values)
+        for migration in self._migrations[version:]:
+            values = migration(values)
+        values[self.schema_version_field] = self.schema_version
+        upgraded = set(key for key in self._fields
+            if key in values and (key not in loaded or loaded[key] != values[key]) or
+            key in loaded and key not in values)
+        return values, upgraded
 
     def __getattr__(self, name):
         field = self._fields.get(name, None)
         if field:
+            extras = self._extras
+            if extras is not None and extras.shared is not None and name in extras.shared:
+                return self._unshare(name, field)
             value = field.default
             if callable(value):
                 value = value()
@@ -370,6 +1018,8 @@ class Document(object):
     def __setattr__(self, name, value):
         field = self._fields.get(name, None)
         if field is not None:
+            if name in self._coerced:
+                value = field._coerce(value)
             if hasattr(field, "_prepare"):
                 value = field._prepare(self, value)
             field._changed(self)
@@ -413,14 +1063,15 @@ class Document(object):
             return True if fields are valid and set if required=False
             see validate_partial
         """
-        if stop_on_required and self._is_valid:
+        self._state &= ~_PROPAGATED
+        if stop_on_required and self._state & _VALID:
             return True
 
         is_valid = self._validate_fields(self._fields.keys(),
             stop_on_required=stop_on_required)
 
         if stop_on_required and is_valid:
-            self._is_valid = True
+            self._state |= _VALID
 
         return is_valid
 
@@ -430,16 +1081,44 @@ class Document(object):
         """
         return self.validate(stop_on_required=False)
 
+    def invalid_fields(self, stop_on_required=True):
+        """ return the sorted list of fields names that do not validate
+        """
+        return [field_name for field_name in sorted(self._fields)
+                if not self._validate_fields([field_name], stop_on_required)]
+
+    def content_hash(self, visibility='public'):
+        """ return a md5 hex digest of the fields and properties of visibility
+            ('save', 'public' or 'owner'), usable as an ETag
+            the digest of each field is cached until the field changes,
+            embedded documents and lists reuse their own cached digests
+        """
+        self._state &= ~_PROPAGATED
+        if visibility == 'save':
+            fields_list = sorted(self._fields)
+        else:
+            fields_list = getattr(self, '%s_fields' % visibility, [])
+        cache = self._get_cache()
+        content = hashlib.md5()
+        for field_name in fields_list:
+            value = getattr(self, field_name)
+            if field_name in self._fields:
+                digests = cache.setdefault(field_name, {})
+                digest = digests.get(visibility)
+                if digest is None:
+                    digest = digests[visibility] = _value_digest(value, visibility)
+            else:
+                # properties are not tracked, hashed every time
+                digest = _value_digest(value, visibility)
+            content.update(field_name.encode('utf-8'))
+            content.update(digest.encode('ascii'))
+        return content.hexdigest()
+
     def _apply_filters(self, filters_list_or_callable, to_filter):
         """ apply all filters function (one arg the dict to filter)
         """
-        try:
-            iter(filters_list_or_callable)
-        except TypeError:
-            if callable(filters_list_or_callable):
-                return filters_list_or_callable(to_filter)
-            else:
-                return to_filter
+        if callable(filters_list_or_callable):
+            return filters_list_or_callable(to_filter)
 
         for filter in filters_list_or_callable:
             if callable(filter):
@@ -448,10 +1127,11 @@ class Document(object):
         return to_filter
 
     def _call_for_visibility_on_child(self, data_dict, fields_list,
-                                      visibility, json_compliant=False):
+                                      visibility, json_compliant=False, serialized=None):
         """ this will call dict_for_%s() visibility on EmbeddedDocument
             and ListField and return a dict
             containing data_dict with key replaced by the result (in place)
+            serialized holds lists already done by iter_dict_for()
         """
         for field in fields_list:
             if isinstance(self._fields[field], EmbeddedDocumentField):
@@ -460,19 +1140,40 @@ class Document(object):
                     data_dict[field] = call_method(json_compliant)
 
             if isinstance(self._fields[field], ListField):
-                if isinstance(self._fields[field].subfield, EmbeddedDocumentField):
+                if serialized is not None and field in serialized:
+                    data_dict[field] = serialized[field]
+                elif isinstance(self._fields[field].subfield, EmbeddedDocumentField):
                     current_field = []
                     for doc in data_dict[field]:
                         call_method = getattr(doc, 'dict_for_%s' % visibility)
                         current_field.append(call_method(json_compliant))
                     data_dict[field] = current_field
+                elif isinstance(data_dict.get(field), array.array):
+                    data_dict[field] = data_dict[field].tolist()
         return data_dict
 
+    def _cached_dict(self, visibility, json_compliant, build):
+        """ return a copy of build(json_compliant) memoized until the next modification
+            the copy protects the cache from callers and filters modifying it
+        """
+        cache = self._get_cache()
+        version = self._extras.version
+        key = (visibility, json_compliant)
+        entry = cache.get(key)
+        if entry is None or entry[0] != version:
+            entry = cache[key] = (version, build(json_compliant))
+        return _copy_result(entry[1])
+
     def dict_for_save(self, json_compliant=False):
         """ return a copy dict with field_name:value
             raise ValidationError if not valid
         """
-        # TODO: put back a cache here if validate has been called earlier
+        self._state &= ~_PROPAGATED
+        if self.cache_dicts:
+            return self._cached_dict('save', json_compliant, self._dict_for_save)
+        return self._dict_for_save(json_compliant)
+
+    def _dict_for_save(self, json_compliant=False, serialized=None):
         if not self.validate():
             raise ValidationException()
 
@@ -484,7 +1185,11 @@ class Document(object):
 
         # we have to call dict_for_save() on embedded document
         save_dict = self._call_for_visibility_on_child(save_dict,
-            self._fields, 'save', json_compliant)
+            self._fields, 'save', json_compliant, serialized)
+
+        for key, db_name in self._db_names.items():
+            if key in save_dict:
+                save_dict[db_name] = save_dict.pop(key)
 
         has_filter = getattr(self, 'pre_save_filter', None)
 
@@ -497,8 +1202,14 @@ class Document(object):
             or return empty dict
             raise ValidationError if not valid
         """
+        self._state &= ~_PROPAGATED
+        if self.cache_dicts:
+            return self._cached_dict('public', json_compliant, self._dict_for_public)
+        return self._dict_for_public(json_compliant)
+
+    def _dict_for_public(self, json_compliant=False, serialized=None):
         public_fields = getattr(self, 'public_fields', [])
-        public_dict = self._dict_for_fields('public', public_fields, json_compliant)
+        public_dict = self._dict_for_fields('public', public_fields, json_compliant, serialized)
         has_filter = getattr(self, 'pre_public_filter', None)
         return public_dict if has_filter is None else\
             self._apply_filters(self.pre_public_filter, public_dict)
@@ -509,13 +1220,20 @@ class Document(object):
             or return empty dict
             raise ValidationError if not valid
         """
+        self._state &= ~_PROPAGATED
+        if self.cache_dicts:
+            return self._cached_dict('owner', json_compliant, self._dict_for_owner)
+        return self._dict_for_owner(json_compliant)
+
+    def _dict_for_owner(self, json_compliant=False, serialized=None):
         owner_fields = getattr(self, 'owner_fields', [])
-        owner_dict = self._dict_for_fields('owner', owner_fields, json_compliant)
+        owner_dict = self._dict_for_fields('owner', owner_fields, json_compliant, serialized)
         has_filter = getattr(self, 'pre_owner_filter', None)
         return owner_dict if has_filter is None else\
             self._apply_filters(self.pre_owner_filter, owner_dict)
 
-    def _dict_for_fields(self, visibility, fields_list=None, json_compliant=False):
+    def _dict_for_fields(self, visibility, fields_list=None, json_compliant=False,
+                         serialized=None):
         """ return a dict with keys specified in fields_list from _data
             or self.property
             or return empty dict
@@ -524,7 +1242,7 @@ class Document(object):
         """
         if fields_list is None:
             return {}
-        if not self._is_valid:
+        if not self._state & _VALID:
             if not self._validate_fields(fields_list, stop_on_required=True):
                 raise ValidationException()
 
@@ -535,7 +1253,7 @@ class Document(object):
 
         # call sub dict_for_method
         subok_dict = self._call_for_visibility_on_child(field_dict, field_dict.keys(),
-            visibility=visibility, json_compliant=json_compliant)
+            visibility=visibility, json_compliant=json_compliant, serialized=serialized)
 
         # find all the keys in public_fields that are NOT fields
         # return a dict with getattr on the obj
@@ -545,10 +1263,214 @@ class Document(object):
 
         return dict(subok_dict.items() + property_dict.items())
 
+    def iter_dict_for(self, visibility='save', json_compliant=False, chunk_size=100):
+        """ generator giving the same dict as dict_for_%s() visibility
+            the lists of embedded documents are serialized by chunks of chunk_size
+            entries, None is yielded after each chunk and the dict is the last value
+            if the document changes between two chunks the serialization restarts
+        """
+        self._state &= ~_PROPAGATED
+        build = getattr(self, '_dict_for_%s' % visibility)
+        if visibility == 'save':
+            fields_list = self._fields
+        else:
+            fields_list = getattr(self, '%s_fields' % visibility, [])
+        list_fields = [field_name for field_name in fields_list
+            if isinstance(self._fields.get(field_name), ListField) and
+            isinstance(self._fields[field_name].subfield, EmbeddedDocumentField)]
+        extras = self._get_extras()
+        while True:
+            version = extras.version
+            if self.cache_dicts and extras.cache is not None:
+                entry = extras.cache.get((visibility, json_compliant))
+                if entry is not None and entry[0] == version:
+                    yield _copy_result(entry[1])
+                    return
+            serialized = {}
+            count = 0
+            for field_name in list_fields:
+                entries = getattr(self, field_name)
+                if entries is None:
+                    continue
+                current_field = []
+                for doc in entries:
+                    call_method = getattr(doc, 'dict_for_%s' % visibility)
+                    current_field.append(call_method(json_compliant))
+                    count += 1
+                    if count % chunk_size == 0:
+                        yield None
+                serialized[field_name] = current_field
+            if extras.version != version:
+                continue
+            if self.cache_dicts:
+                yield self._cached_dict(visibility, json_compliant,
+                    lambda json_compliant: build(json_compliant, serialized))
+            else:
+                yield build(json_compliant, serialized)
+            return
+
+    def clone(self):
+        """ return a copy of the document, with the same modified fields
+            values are shared: lists and embedded documents are copied
+            on the first access to them from the clone, or for the clones
+            when the document changes them
+        """
+        extras = self._extras
+        # fields of a clone not read yet, still in the holder of its document
+        inherited = extras.shared if extras is not None else None
+        copy = self.__class__.__new__(self.__class__)
+        copy_shared = {}
+        shared_values = {}
+        for field_name in self._fields:
+            try:
+                value = object.__getattribute__(self, field_name)
+            except AttributeError:
+                if inherited is not None and field_name in inherited:
+                    copy_shared[field_name] = inherited[field_name]
+                continue
+            if isinstance(value, (Document,) + _SEQUENCES):
+                shared_values[field_name] = value
+            else:
+                object.__setattr__(copy, field_name, value)
+        if shared_values:
+            shared = None
+            if extras is not None and extras.watchers is not None:
+                for watcher in extras.watchers:
+                    # unchanged since it was made, and no value read since either
+                    if isinstance(watcher, _Shared) and watcher.fresh and \
+                            len(watcher.values) == len(shared_values):
+                        shared = watcher
+            if shared is None:
+                shared = _Shared(self, shared_values)
+            for field_name in shared_values:
+                copy_shared[field_name] = shared
+        copy._state = self._state & ~_PROPAGATED
+        copy._parent = None
+        copy._parent_field = None
+        copy._extras = None
+        if copy_shared or extras is not None and extras.snapshot is not None:
+            copy._extras = _Extras()
+            if copy_shared:
+                copy._extras.shared = copy_shared
+            if extras is not None and extras.snapshot is not None:
+                copy._extras.snapshot = dict((field_name, _freeze(value))
+                    for field_name, value in extras.snapshot.items())
+        return copy
+
+    def _unshare(self, field_name, field):
+        """ set a copy of the shared value of field_name in this clone
+        """
+        extras = self._extras
+        value = _copy_value(extras.shared.pop(field_name).values[field_name])
+        if not extras.shared:
+            extras.shared = None
+        value = field._prepare(self, value)
+        object.__setattr__(self, field_name, value)
+        if not self._state & self._field_bits[field_name]:
+            # not modified here, the copied embedded documents are not either
+            for child in _embedded_documents(self):
+                if child._parent_field is field:
+                    child.mark_clean()
+        return value
+
+    def _get_extras(self):
+        """ return the _Extras of the document, allocated on first use
+        """
+        extras = self._extras
+        if extras is None:
+            self._extras = extras = _Extras()
+        return extras
+
+    def _get_cache(self):
+        extras = self._get_extras()
+        if extras.cache is None:
+            extras.cache = {}
+        return extras.cache
+
+    def _add_watcher(self, watcher):
+        """ watcher._document_changed(document, field_name) is called
+            before each change of a field
+        """
+        extras = self._get_extras()
+        if extras.watchers is None:
+            extras.watchers = []
+        extras.watchers.append(watcher)
+
+    def _remove_watcher(self, watcher):
+        # a new list: a watcher removes itself while _changed iterates over them
+        watchers = list(self._extras.watchers)
+        watchers.remove(watcher)
+        self._extras.watchers = watchers or None
+
+    def _has_watcher(self, watcher):
+        extras = self._extras
+        return extras is not None and extras.watchers is not None and \
+            watcher in extras.watchers
+
+    def mark_clean(self):
+        """ forget the modified fields of the document and its embedded documents
+            to call after a save, with track_snapshot the current values become
+            the loaded ones, a savepoint is released
+        """
+        self._state &= _VALID
+        extras = self._extras
+        if extras is not None:
+            extras.savepoint = None
+        if extras is not None and extras.snapshot is not None:
+            shared = extras.shared
+            snapshot = extras.snapshot = {}
+            for field_name in self._fields:
+                try:
+                    snapshot[field_name] = object.__getattribute__(self, field_name)
+                except AttributeError:
+                    if shared is not None and field_name in shared:
+                        # the shared value can still change in its document
+                        snapshot[field_name] = _freeze(shared[field_name].values[field_name])
+        for child in _embedded_documents(self):
+            child.mark_clean()
+
+    def savepoint(self):
+        """ start recording the values of the fields changed from now
+            replace a previous savepoint
+        """
+        # changes in embedded documents have to reach this document
+        _clear_propagated(self)
+        self._get_extras().savepoint = {_SAVEPOINT_STATE: self._state}
+
+    def rollback(self):
+        """ restore the fields changed since savepoint() and their modified state
+            the savepoint is released, raise ValueError without savepoint
+        """
+        extras = self._extras
+        savepoint = None if extras is None else extras.savepoint
+        if savepoint is None:
+            raise ValueError('rollback without savepoint')
+        extras.savepoint = None
+        state = savepoint.pop(_SAVEPOINT_STATE)
+        restored = 0
+        for field_name, saved in savepoint.items():
+            value = _restore(saved)
+            if not _same(getattr(self, field_name), value):
+                setattr(self, field_name, value)
+            restored |= self._field_bits[field_name]
+        self._state = (self._state & ~restored) | (state & restored & ~_VALID)
+
     def modified_fields(self):
         """ return a set of fields modified via setters
+            with track_snapshot only fields whose value differs from the loaded one
+            the set is a copy, a shared frozenset if none, see mark_clean() to reset
         """
-        return self._modified_fields
+        state = self._state
+        if not state & ~(_VALID | _PROPAGATED):
+            return _NO_FIELDS
+        modified = set(field_name for field_name, bit in self._field_bits.items()
+                       if state & bit)
+        snapshot = None if self._extras is None else self._extras.snapshot
+        if snapshot is None:
+            return modified
+        return set(field_name for field_name in modified
+                   if _freeze(getattr(self, field_name)) !=
+                   _freeze(snapshot.get(field_name)))
 
     def dict_for_modified_fields(self, validate=True):
         """ return a dict of fields modified via setters as key with value
@@ -558,7 +1480,582 @@ class Document(object):
         if validate and not self.validate_partial():
             raise ValidationException()
 
-        return {good_key: getattr(self, good_key) for good_key in self._modified_fields}
+        db_names = self._db_names
+        return {db_names.get(good_key, good_key): getattr(self, good_key)
+                for good_key in self.modified_fields()}
+
+    @classmethod
+    def from_dict(cls, raw, parent=None, parent_field=None):
+        """ return a document from a dict of values
+            with a discriminator the subclass is picked from its value
+            in a single lookup, raise ValueError if it is unknown
+        """
+        discriminator = cls.discriminator
+        if discriminator is None:
+            return cls(parent=parent, parent_field=parent_field, **raw)
+        value = raw.get(cls._db_names.get(discriminator, discriminator))
+        if value is None:
+            value = raw.get(discriminator)
+        klass = cls if value is None else cls._registry.get(value)
+        if klass is None or not issubclass(klass, cls):
+            raise ValueError('Unknown %s %r for %s' % (discriminator, value, cls.__name__))
+        return klass(parent=parent, parent_field=parent_field, **raw)
+
+    @classmethod
+    def from_json(cls, data):
+        """ return a document of this class from a JSON object
+            data can be bytes, text or a stream with a read() method
+            embedded documents are built while parsing without intermediate dict
+        """
+        return _JSONReader(data).read_document(cls)
+
+    @classmethod
+    def iter_json(cls, stream, chunk_size=65536):
+        """ yield documents of this class from a top level JSON array
+            the stream is read by chunks so memory does not grow with its size
+        """
+        return _JSONReader(stream, chunk_size).iter_documents(cls)
+
+    def diff(self, other):
+        """ return the minimal changes to apply on self to get other
+            as a mongo update with $set, $unset and $push keys
+            paths are dotted through EmbeddedDocumentField and ListField items
+            with the db_name of the fields, embedded values are given as dict_for_save()
+            a list with changed items and new items is set entirely, mongo
+            refuses a $push and a $set on the same list
+        """
+        if other.__class__ is not self.__class__:
+            raise TypeError('diff only works between documents of the same class')
+        delta = {}
+        self._diff_fields(other, '', delta)
+        return delta
+
+    def _diff_fields(self, other, prefix, delta):
+        db_names = self._db_names
+        for field_name, field in self._fields.items():
+            path = prefix + db_names.get(field_name, field_name)
+            mine = getattr(self, field_name)
+            theirs = getattr(other, field_name)
+            if theirs is None:
+                if mine is not None:
+                    delta.setdefault('$unset', {})[path] = ''
+            elif mine is None:
+                delta.setdefault('$set', {})[path] = _diff_value(theirs)
+            elif isinstance(field, EmbeddedDocumentField) and \
+                    isinstance(mine, Document) and mine.__class__ is theirs.__class__:
+                mine._diff_fields(theirs, path + '.', delta)
+            elif isinstance(field, ListField) and isinstance(mine, _SEQUENCES) and \
+                    isinstance(theirs, _SEQUENCES) and len(mine) <= len(theirs):
+                _diff_list(mine, theirs, path, delta)
+            elif mine != theirs:
+                delta.setdefault('$set', {})[path] = _diff_value(theirs)
+
+    def _resolve_path(self, path):
+        """ return the container (Document or list) and the last key of a dotted path
+        """
+        keys = path.split('.')
+        container = self
+        for key in keys[:-1]:
+            if isinstance(container, list):
+                container = container[int(key)]
+            else:
+                container = getattr(container, _field_name(container, key))
+        key = keys[-1]
+        if isinstance(container, Document):
+            key = _field_name(container, key)
+        return container, key
+
+    def apply_diff(self, delta):
+        """ apply changes returned by diff(), modifications are tracked
+            as if they were done via setters
+        """
+        for path, value in delta.get('$set', {}).items():
+            container, key = self._resolve_path(path)
+            if isinstance(container, _SEQUENCES):
+                subfield = container._field.subfield
+                if hasattr(subfield, '_prepare'):
+                    value = subfield._prepare(container._parent, value)
+                container[int(key)] = value
+            else:
+                setattr(container, key, value)
+
+        for path in delta.get('$unset', {}).keys():
+            container, key = self._resolve_path(path)
+            setattr(container, key, None)
+
+        for path, value in delta.get('$push', {}).items():
+            container, key = self._resolve_path(path)
+            container = getattr(container, key)
+            subfield = container._field.subfield
+            values = value['$each']
+            if hasattr(subfield, '_prepare'):
+                values = [subfield._prepare(container._parent, entry) for entry in values]
+            container.extend(values)
+
+
+def _document_fields(document_class):
+    """ return the names of the fields holding documents, computed once per class
+    """
+    if '_document_fields' not in document_class.__dict__:
+        document_class._document_fields = tuple(field_name
+            for field_name, field in sorted(document_class._fields.items())
+            if isinstance(field, EmbeddedDocumentField) or
+            isinstance(field, ListField) and isinstance(field.subfield, EmbeddedDocumentField))
+    return document_class._document_fields
+
+
+def _computed_dependents(document_class):
+    """ return {field_name: names of the computed properties depending on it}
+        cached in the class, raise AttributeError for an unknown dependency
+    """
+    if '_computed_dependents' not in document_class.__dict__:
+        dependents = {}
+        for name in dir(document_class):
+            value = getattr(document_class, name, None)
+            if not isinstance(value, ComputedProperty):
+                continue
+            for field_name in value.depends_on:
+                if field_name not in document_class._fields:
+                    raise AttributeError('%s depends on %s which is not a field of %s' %
+                        (name, field_name, document_class.__name__))
+                dependents.setdefault(field_name, []).append(name)
+        document_class._computed_dependents = dict((field_name, tuple(names))
+            for field_name, names in dependents.items())
+    return document_class._computed_dependents
+
+
+def _embedded_documents(document):
+    """ yield the documents held by the fields of document, unset fields are skipped
+    """
+    for field_name in _document_fields(document.__class__):
+        try:
+            value = object.__getattribute__(document, field_name)
+        except AttributeError:
+            continue
+        if isinstance(value, Document):
+            yield value
+        elif isinstance(value, list):
+            for entry in value:
+                if isinstance(entry, Document):
+                    yield entry
+
+
+def _has_watched_parent(document):
+    """ return True if a parent of document has class watchers
+    """
+    parent = document._parent
+    while parent is not None:
+        if parent._class_watchers:
+            return True
+        parent = parent._parent
+    return False
+
+
+def _clear_propagated(document):
+    """ make the next changes of document and its embedded documents
+        propagate to their parents again
+    """
+    document._state &= ~_PROPAGATED
+    for child in _embedded_documents(document):
+        _clear_propagated(child)
+
+
+def _copy_result(value):
+    """ copy the dicts and lists of a dict_for_* result, other values are shared
+    """
+    if isinstance(value, dict):
+        return dict((key, _copy_result(entry)) for key, entry in value.items())
+    if isinstance(value, list):
+        # lists are homogeneous once validated, the first entry tells if we recurse
+        if value and isinstance(value[0], (dict, list)):
+            return [_copy_result(entry) for entry in value]
+        return list(value)
+    return value
+
+
+# containers of ListField values
+_SEQUENCES = (list, array.array)
+
+
+def _value_digest(value, visibility):
+    """ return the md5 hex digest of a field value for Document.content_hash
+        str and unicode with the same text get the same digest
+    """
+    if isinstance(value, Document):
+        return value.content_hash(visibility)
+    if isinstance(value, _SEQUENCES):
+        content = hashlib.md5(b'[')
+        for entry in value:
+            content.update(_value_digest(entry, visibility).encode('ascii'))
+        return content.hexdigest()
+    return hashlib.md5(json.dumps(value, default=unicode).encode('utf-8')).hexdigest()
+
+
+def _freeze(value):
+    """ return an immutable copy of value, documents and lists included
+        used to compare a value with a snapshot
+    """
+    if isinstance(value, Document):
+        return (value.__class__, tuple((field_name, _freeze(getattr(value, field_name)))
+            for field_name in sorted(value._fields)))
+    if isinstance(value, list):
+        return tuple(_freeze(entry) for entry in value)
+    if isinstance(value, array.array):
+        return tuple(value)
+    return value
+
+
+class _Shared(object):
+    """
+        values of a document shared with its clones
+        watches the document to keep a private copy of a value before it changes
+    """
+    __slots__ = ('values', 'live', 'fresh', 'document')
+
+    def __init__(self, document, values):
+        self.values = values
+        # fields whose value is still the one of the document
+        self.live = set(values)
+        # new clones can share it until the document changes
+        self.fresh = True
+        self.document = document
+        # changes in embedded documents have to reach the document
+        _clear_propagated(document)
+        document._add_watcher(self)
+
+    def _document_changed(self, document, field_name):
+        self.fresh = False
+        if field_name in self.live:
+            self.values[field_name] = _copy_value(self.values[field_name])
+            self.live.discard(field_name)
+            if not self.live:
+                document._remove_watcher(self)
+                self.document = None
+
+
+def _copy_value(value):
+    """ copy a list or embedded document value for a clone, nested ones included
+        the copy shares nothing: it is taken before a change deep in value
+    """
+    if isinstance(value, Document):
+        return _copy_document(value)
+    if isinstance(value, array.array):
+        return array.array(value.typecode, value)
+    if isinstance(value, list):
+        return [_copy_value(entry) for entry in value]
+    return value
+
+
+def _copy_document(document):
+    """ return a copy of document with the same modified fields, see _copy_value()
+    """
+    copy = document.__class__.__new__(document.__class__)
+    copy._state = document._state & ~_PROPAGATED
+    copy._parent = None
+    copy._parent_field = None
+    copy._extras = None
+    extras = document._extras
+    shared = extras.shared if extras is not None else None
+    for field_name, field in document._fields.items():
+        try:
+            value = object.__getattribute__(document, field_name)
+        except AttributeError:
+            if shared is None or field_name not in shared:
+                continue
+            value = shared[field_name].values[field_name]
+        if isinstance(value, (Document,) + _SEQUENCES):
+            value = _copy_value(value)
+            if hasattr(field, '_prepare'):
+                value = field._prepare(copy, value)
+        object.__setattr__(copy, field_name, value)
+    if extras is not None and extras.snapshot is not None:
+        copy._extras = _Extras()
+        copy._extras.snapshot = dict((field_name, _freeze(value))
+            for field_name, value in extras.snapshot.items())
+    return copy
+
+
+class _SavedDocument(object):
+    """
+        an embedded document at savepoint(), restored in place by rollback()
+        so the references held on it stay valid
+    """
+    __slots__ = ('document', 'state', 'values')
+
+    def __init__(self, document):
+        self.document = document
+        self.state = document._state
+        self.values = dict((field_name, _save(getattr(document, field_name)))
+            for field_name in document._fields)
+
+
+def _save(value):
+    """ return a copy of value for _restore(), lists and arrays are copied
+        and documents saved with the values of their fields
+    """
+    if isinstance(value, Document):
+        return _SavedDocument(value)
+    if isinstance(value, list):
+        return [_save(entry) for entry in value]
+    if isinstance(value, array.array):
+        return array.array(value.typecode, value)
+    return value
+
+
+def _restore(saved):
+    """ return the value given to _save(), its documents restored in place
+        with their modified state
+    """
+    if isinstance(saved, _SavedDocument):
+        document = saved.document
+        for field_name, entry in saved.values.items():
+            value = _restore(entry)
+            if not _same(getattr(document, field_name), value):
+                setattr(document, field_name, value)
+        # the parent is marked by the caller, later changes have to reach it
+        document._state = saved.state & ~(_VALID | _PROPAGATED)
+        return document
+    if isinstance(saved, list):
+        return [_restore(entry) for entry in saved]
+    return saved
+
+
+def _same(value, other):
+    """ return True if value can be kept instead of setting other
+    """
+    if isinstance(value, Document) or isinstance(other, Document):
+        return value is other
+    if isinstance(value, list) and isinstance(other, list):
+        return len(value) == len(other) and all(
+            _same(entry, other_entry) for entry, other_entry in zip(value, other))
+    if isinstance(value, array.array) and isinstance(other, array.array):
+        return value.typecode == other.typecode and value == other
+    return type(value) is type(other) and value == other
+
+
+def _diff_value(value):
+    """ return value as it should be sent in a diff
+    """
+    if isinstance(value, Document):
+        return value.dict_for_save()
+    if isinstance(value, list):
+        return [_diff_value(entry) for entry in value]
+    if isinstance(value, array.array):
+        return value.tolist()
+    return value
+
+
+def _field_name(document, db_name):
+    """ return the name of the field stored as db_name in document
+    """
+    for field_name, name in document._db_names.items():
+        if name == db_name:
+            return field_name
+    return db_name
+
+
+def _diff_list(mine, theirs, path, delta):
+    """ diff the common part of two lists item by item
+        and push the items theirs has in more
+        if both are needed the list is set entirely
+    """
+    if len(theirs) > len(mine):
+        changes = {}
+        _diff_list(mine, theirs[:len(mine)], path, changes)
+        if changes:
+            delta.setdefault('$set', {})[path] = _diff_value(theirs)
+        else:
+            delta.setdefault('$push', {})[path] = {'$each':
+                _diff_value(theirs[len(mine):])}
+        return
+    for index, entry in enumerate(mine):
+        other_entry = theirs[index]
+        entry_path = '%s.%d' % (path, index)
+        if isinstance(entry, Document) and entry.__class__ is other_entry.__class__:
+            entry._diff_fields(other_entry, entry_path + '.', delta)
+        elif entry != other_entry:
+            delta.setdefault('$set', {})[entry_path] = _diff_value(other_entry)
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_PARSE_ERRORS = (ValueError, StopIteration, IndexError)
+
+
+class _SchemaError(Exception):
+    """ wraps an error raised while building a parsed document
+        the JSON was complete, reading more of the stream would not help
+    """
+
+
+def _input_fields(document_class):
+    """ return a dict of the keys accepted at construction to their field
+        computed once per class
+    """
+    if '_input_fields' not in document_class.__dict__:
+        input_fields = {}
+        if document_class.discriminator is not None:
+            # the values of a subclass can come before the discriminator
+            for klass in document_class._registry.values():
+                if issubclass(klass, document_class) and klass is not document_class:
+                    input_fields.update(_input_fields(klass))
+        input_fields.update(document_class._fields)
+        for alias, field_name in document_class._aliases:
+            input_fields[alias] = document_class._fields[field_name]
+        for field_name, db_name in document_class._db_names.items():
+            input_fields[db_name] = document_class._fields[field_name]
+        document_class._input_fields = input_fields
+    return document_class._input_fields
+
+
+class _JSONReader(object):
+    """
+        JSON parser directed by the Document schema
+        objects of EmbeddedDocumentField and ListField of EmbeddedDocumentField
+        are built as Documents while parsing, other values are scanned by json
+        a stream is read by chunks, a value cut by the end of a chunk is parsed again
+    """
+    def __init__(self, data, chunk_size=65536):
+        self.pos = 0
+        self.chunk_size = chunk_size
+        self.scan_once = json.JSONDecoder().scan_once
+        if hasattr(data, 'read'):
+            self.stream = data
+            self.decoder = codecs.getincrementaldecoder('utf-8')()
+            self.buf = u''
+            self.eof = False
+        else:
+            self.stream = None
+            self.buf = data.decode('utf-8') if isinstance(data, bytes) else data
+            self.eof = True
+
+    def _fill(self, size):
+        """ drop what has been parsed and read size more characters from the stream
+        """
+        chunk = self.stream.read(size)
+        # a short read can end inside a character and decode to nothing
+        self.eof = not chunk
+        if isinstance(chunk, bytes):
+            chunk = self.decoder.decode(chunk, final=self.eof)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def _parse(self, func):
+        """ call func at the current position and move after what it parsed
+            read more of the stream and try again if it failed before the end
+        """
+        size = self.chunk_size
+        while True:
+            try:
+                result, self.pos = func(self.pos)
+                return result
+            except _SchemaError as error:
+                raise error.args[0]
+            except _PARSE_ERRORS:
+                if self.eof:
+                    raise ValueError('Invalid JSON at char %d' % self.pos)
+            self._fill(size)
+            # a value bigger than a chunk: read more each time
+            size *= 2
+
+    def _skip(self, idx, char):
+        idx = _WHITESPACE.match(self.buf, idx).end()
+        if self.buf[idx] != char:
+            raise ValueError('Expecting %s at char %d' % (char, idx))
+        return idx + 1
+
+    def _value(self, idx, field):
+        idx = _WHITESPACE.match(self.buf, idx).end()
+        char = self.buf[idx]
+        if char == '{' and isinstance(field, EmbeddedDocumentField):
+            return self._document(idx, field.field_type)
+        if char == '[' and isinstance(field, ListField) and \
+                isinstance(field.subfield, EmbeddedDocumentField):
+            return self._list(idx, field.subfield)
+        return self.scan_once(self.buf, idx)
+
+    def _document(self, idx, document_class):
+        buf = self.buf
+        input_fields = _input_fields(document_class)
+        idx = self._skip(idx, '{')
+        values = {}
+        idx = _WHITESPACE.match(buf, idx).end()
+        if buf[idx] == '}':
+            return self._build(document_class, values), idx + 1
+        while True:
+            if buf[idx] != '"':
+                raise ValueError('Expecting property name at char %d' % idx)
+            key, idx = json.decoder.scanstring(buf, idx + 1)
+            idx = self._skip(idx, ':')
+            value, idx = self._value(idx, input_fields.get(key))
+            values[key] = value
+            idx = _WHITESPACE.match(buf, idx).end()
+            if buf[idx] == '}':
+                return self._build(document_class, values), idx + 1
+            idx = _WHITESPACE.match(buf, self._skip(idx, ',')).end()
+
+    def _build(self, document_class, values):
+        try:
+            return document_class.from_dict(values)
+        except Exception as error:
+            raise _SchemaError(error)
+
+    def _list(self, idx, subfield):
+        buf = self.buf
+        idx = _WHITESPACE.match(buf, self._skip(idx, '[')).end()
+        entries = []
+        if buf[idx] == ']':
+            return entries, idx + 1
+        while True:
+            entry, idx = self._value(idx, subfield)
+            entries.append(entry)
+            idx = _WHITESPACE.match(buf, idx).end()
+            if buf[idx] == ']':
+                return entries, idx + 1
+            idx = self._skip(idx, ',')
+
+    def _end(self):
+        """ raise ValueError if anything but whitespace follows what has been parsed
+        """
+        while True:
+            idx = _WHITESPACE.match(self.buf, self.pos).end()
+            if idx < len(self.buf):
+                raise ValueError('Extra data at char %d' % idx)
+            if self.eof:
+                return
+            self.pos = idx
+            self._fill(self.chunk_size)
+
+    def read_document(self, document_class):
+        if self.stream is not None:
+            self._fill(self.chunk_size)
+        document = self._parse(lambda idx: self._document(idx, document_class))
+        self._end()
+        return document
+
+    def iter_documents(self, document_class):
+        def _open(idx):
+            idx = _WHITESPACE.match(self.buf, self._skip(idx, '[')).end()
+            return self.buf[idx] == ']', idx
+
+        def _entry(idx):
+            document, idx = self._document(idx, document_class)
+            idx = _WHITESPACE.match(self.buf, idx).end()
+            # the delimiter has to be read too, a cut number would look valid
+            if self.buf[idx] == ']':
+                return (document, True), idx + 1
+            return (document, False), self._skip(idx, ',')
+
+        if self.stream is not None:
+            self._fill(self.chunk_size)
+        if self._parse(_open):
+            return
+        while True:
+            document, last = self._parse(_entry)
+            if last:
+                self._end()
+            yield document
+            if last:
+                return
 
 
 # Filters
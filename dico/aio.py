@@ -0,0 +1,265 @@
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        raise ImportError(
+            'Using dico.aio requires asyncio or trollius. '
+        )
+
+from . import ValidationException
+
+try:
+    StopAsyncIteration
+except NameError:
+    class StopAsyncIteration(Exception):
+        pass
+
+
+def _chain(future, func, loop):
+    """ return a new future resolved with func(result of future)
+        if func returns a future or a coroutine it is awaited too
+        written with callbacks so it runs with asyncio and trollius
+    """
+    chained = asyncio.Future(loop=loop)
+
+    def _forward(inner):
+        if inner.cancelled():
+            chained.cancel()
+        elif inner.exception() is not None:
+            chained.set_exception(inner.exception())
+        else:
+            chained.set_result(inner.result())
+
+    def _done(done_future):
+        if done_future.cancelled():
+            chained.cancel()
+            return
+        if done_future.exception() is not None:
+            chained.set_exception(done_future.exception())
+            return
+        try:
+            value = func(done_future.result())
+        except Exception as e:
+            chained.set_exception(e)
+            return
+        if isinstance(value, asyncio.Future) or asyncio.iscoroutine(value):
+            asyncio.ensure_future(value, loop=loop).add_done_callback(_forward)
+        else:
+            chained.set_result(value)
+
+    asyncio.ensure_future(future, loop=loop).add_done_callback(_done)
+    return chained
+
+
+def _resolved(value, loop):
+    future = asyncio.Future(loop=loop)
+    future.set_result(value)
+    return future
+
+
+def _run(loop, func, args, offload, executor):
+    """ call func(*args) on the loop or in executor if offload is set
+        always return a future
+    """
+    if offload:
+        return loop.run_in_executor(executor, func, *args)
+    future = asyncio.Future(loop=loop)
+    try:
+        future.set_result(func(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def hydrate(document_class, raw_list, validate=False):
+    """ build a list of document_class from a list of dict
+        raise ValidationException if validate is set and a document is not valid
+    """
+    documents = [document_class.from_dict(raw) for raw in raw_list]
+    if validate:
+        for document in documents:
+            if not document.validate():
+                raise ValidationException()
+    return documents
+
+
+def serialize(documents, visibility='save', json_compliant=False):
+    """ return the list of dict_for_%s() visibility of documents
+    """
+    return [getattr(document, 'dict_for_%s' % visibility)(json_compliant)
+            for document in documents]
+
+
+class AsyncDocumentCursor(object):
+    """
+        Wrap an async cursor (anything with a to_list(length) returning a future
+        like motor) to fetch Documents by batch of batch_size
+        building and validating a batch can be sent to an executor with offload=True
+    """
+    def __init__(self, document_class, cursor, batch_size=100, validate=False,
+                 offload=False, executor=None, loop=None):
+        self.document_class = document_class
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.validate = validate
+        self.offload = offload
+        self.executor = executor
+        self.loop = loop or asyncio.get_event_loop()
+        self._buffer = []
+        self._exhausted = False
+
+    def _fill(self, raw_list):
+        if len(raw_list) < self.batch_size:
+            self._exhausted = True
+        return _chain(_run(self.loop, hydrate,
+            (self.document_class, raw_list, self.validate),
+            self.offload, self.executor), self._buffered, self.loop)
+
+    def _buffered(self, documents):
+        self._buffer = documents[::-1]
+        return self._pop()
+
+    def _pop(self):
+        if self._buffer:
+            return self._buffer.pop()
+        return None
+
+    def fetch_next(self):
+        """ return a future resolved with the next Document or None when exhausted
+        """
+        if self._buffer or self._exhausted:
+            return _resolved(self._pop(), self.loop)
+        return _chain(self.cursor.to_list(self.batch_size), self._fill, self.loop)
+
+    def to_list(self):
+        """ return a future resolved with all the remaining Documents
+        """
+        documents = []
+
+        def _collect(document):
+            if document is None:
+                return documents
+            documents.append(document)
+            return _chain(self.fetch_next(), _collect, self.loop)
+
+        return _chain(self.fetch_next(), _collect, self.loop)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        def _stop(document):
+            if document is None:
+                raise StopAsyncIteration()
+            return document
+        return _chain(self.fetch_next(), _stop, self.loop)
+
+
+def find(document_class, collection, spec=None, **kwargs):
+    """ shortcut for AsyncDocumentCursor(document_class, collection.find(spec))
+        kwargs are passed to AsyncDocumentCursor
+    """
+    return AsyncDocumentCursor(document_class, collection.find(spec), **kwargs)
+
+
+def save_modified(collection, document, spec, offload=False, executor=None, loop=None):
+    """ send an update with $set of dict_for_modified_fields() to collection
+        return a future resolved with the update result
+        or None if there was nothing to update
+    """
+    loop = loop or asyncio.get_event_loop()
+
+    def _update(modified_dict):
+        if not modified_dict:
+            return None
+        return collection.update_one(spec, {'$set': modified_dict})
+
+    return _chain(_run(loop, document.dict_for_modified_fields, (),
+        offload, executor), _update, loop)
+
+
+def serialize_many(documents, visibility='save', json_compliant=False,
+                   offload=False, executor=None, loop=None):
+    """ return a future resolved with the list of dict_for_%s() visibility
+        of documents, with offload=True the work is done in executor
+    """
+    loop = loop or asyncio.get_event_loop()
+    return _run(loop, serialize, (documents, visibility, json_compliant),
+        offload, executor)
+
+
+def serialize_chunked(document, visibility='save', json_compliant=False,
+                      chunk_size=100, budget=0.005, loop=None):
+    """ return a future resolved with dict_for_%s() visibility of document
+        the lists of embedded documents are serialized on the loop by chunks
+        of chunk_size entries, control goes back to the loop when a chunk ends
+        after budget seconds of work so other tasks keep running
+    """
+    loop = loop or asyncio.get_event_loop()
+    future = asyncio.Future(loop=loop)
+    steps = document.iter_dict_for(visibility, json_compliant, chunk_size)
+
+    def _step():
+        if future.cancelled():
+            steps.close()
+            return
+        deadline = loop.time() + budget
+        try:
+            for value in steps:
+                if value is not None:
+                    future.set_result(value)
+                    return
+                if loop.time() >= deadline:
+                    loop.call_soon(_step)
+                    return
+        except Exception as e:
+            future.set_exception(e)
+
+    loop.call_soon(_step)
+    return future
+
+
+class MemoryCursor(object):
+    """ in memory stand-in of an async cursor, to_list returns a future
+    """
+    def __init__(self, results, loop=None):
+        self._results = results
+        self._loop = loop
+
+    def to_list(self, length=None):
+        loop = self._loop or asyncio.get_event_loop()
+        if length is None:
+            batch, self._results = self._results, []
+        else:
+            batch, self._results = self._results[:length], self._results[length:]
+        return _resolved(batch, loop)
+
+
+class MemoryCollection(object):
+    """
+        in memory stand-in of an async collection for tests
+        only supports equality in spec and $set in updates
+    """
+    def __init__(self, documents=None, loop=None):
+        self.documents = list(documents or [])
+        self._loop = loop
+
+    def _match(self, spec):
+        spec = spec or {}
+        return [raw for raw in self.documents
+                if all(raw.get(key) == value for key, value in spec.items())]
+
+    def find(self, spec=None):
+        return MemoryCursor([dict(raw) for raw in self._match(spec)], self._loop)
+
+    def insert_one(self, raw):
+        self.documents.append(dict(raw))
+        return _resolved(None, self._loop or asyncio.get_event_loop())
+
+    def update_one(self, spec, update):
+        matched = self._match(spec)
+        if matched:
+            matched[0].update(update.get('$set', {}))
+        return _resolved(len(matched[:1]), self._loop or asyncio.get_event_loop())
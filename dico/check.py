@@ -0,0 +1,167 @@
+"""
+    Validate NDJSON or mongoexport dumps against a Document class
+
+    python -m dico.check [-w WORKERS] [-n SAMPLES] package.module.Class dump.json [...]
+
+    Files are memory-mapped and split in chunks on line boundaries,
+    chunks are checked by a pool of worker processes.
+    Prints the failures count per field with sample line numbers,
+    exits with 1 if a record failed.
+"""
+import argparse
+import importlib
+import json
+import mmap
+import multiprocessing
+import os
+import sys
+
+try:
+    from bson import json_util
+    # mongoexport extended JSON, {"$oid": ...} and {"$date": ...}
+    _object_hook = json_util.object_hook
+except ImportError:
+    _object_hook = None
+
+# failures that are not a field
+JSON_ERROR = '<json>'
+DOCUMENT_ERROR = '<document>'
+
+_document_classes = {}
+
+
+def load_class(path):
+    """ import package.module.Class, cached per process
+    """
+    if path not in _document_classes:
+        module_name, _, class_name = path.rpartition('.')
+        _document_classes[path] = getattr(importlib.import_module(module_name), class_name)
+    return _document_classes[path]
+
+
+def record_failures(document_class, line):
+    """ return the list of failures of a NDJSON line
+        empty if it builds a valid document
+    """
+    try:
+        raw = json.loads(line, object_hook=_object_hook)
+    except ValueError:
+        return [JSON_ERROR]
+    if not isinstance(raw, dict):
+        return [JSON_ERROR]
+    try:
+        document = document_class.from_dict(raw)
+    except (ValueError, TypeError):
+        return [DOCUMENT_ERROR]
+    if document.validate():
+        return []
+    return document.invalid_fields() or [DOCUMENT_ERROR]
+
+
+def check_chunk(task):
+    """ check the lines starting in [start, end) of a file
+        return (lines, records, failures per field, sample line indexes per field)
+        line indexes are relative to the first line of the chunk
+    """
+    class_path, path, start, end, samples = task
+    document_class = load_class(class_path)
+    lines = records = 0
+    failures = {}
+    sample_lines = {}
+    with open(path, 'rb') as dump:
+        mm = mmap.mmap(dump.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            size = mm.size()
+            # the line cut by start belongs to the previous chunk
+            if start > 0 and mm[start - 1:start] != b'\n':
+                newline = mm.find(b'\n', start)
+                start = size if newline == -1 else newline + 1
+            pos = start
+            while pos < end:
+                newline = mm.find(b'\n', pos)
+                stop = size if newline == -1 else newline
+                line = mm[pos:stop].strip()
+                if line:
+                    records += 1
+                    for field_name in record_failures(document_class, line):
+                        failures[field_name] = failures.get(field_name, 0) + 1
+                        field_samples = sample_lines.setdefault(field_name, [])
+                        if len(field_samples) < samples:
+                            field_samples.append(lines)
+                lines += 1
+                pos = stop + 1
+        finally:
+            mm.close()
+    return lines, records, failures, sample_lines
+
+
+def split(path, chunks, min_chunk_size=1 << 20):
+    """ return (start, end) byte ranges splitting path in about chunks parts
+    """
+    size = os.path.getsize(path)
+    chunk_size = max(min_chunk_size, size // max(chunks, 1) + 1)
+    return [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+
+def check_file(class_path, path, workers=None, samples=5, pool=None, min_chunk_size=1 << 20):
+    """ return (records, failures per field, sample line numbers per field)
+        line numbers start at 1
+    """
+    workers = workers or multiprocessing.cpu_count()
+    tasks = [(class_path, path, start, end, samples)
+             for start, end in split(path, workers * 8, min_chunk_size)]
+    results = pool.imap(check_chunk, tasks) if pool is not None else map(check_chunk, tasks)
+
+    first_line = 1
+    total_records = 0
+    failures = {}
+    sample_lines = {}
+    for lines, records, chunk_failures, chunk_samples in results:
+        total_records += records
+        for field_name, count in chunk_failures.items():
+            failures[field_name] = failures.get(field_name, 0) + count
+            field_samples = sample_lines.setdefault(field_name, [])
+            field_samples.extend(first_line + line for line in chunk_samples[field_name])
+            del field_samples[samples:]
+        first_line += lines
+    return total_records, failures, sample_lines
+
+
+def report(path, records, failures, sample_lines, out=sys.stdout):
+    out.write('%s: %d records, %d failures\n' % (path, records, sum(failures.values())))
+    for field_name, count in sorted(failures.items(), key=lambda item: (-item[1], item[0])):
+        out.write('  %-30s %10d  lines %s\n' % (field_name, count,
+            ', '.join(str(line) for line in sample_lines[field_name])))
+
+
+def main(argv=None, out=sys.stdout):
+    parser = argparse.ArgumentParser(prog='python -m dico.check',
+        description='Validate NDJSON or mongoexport dumps against a Document class')
+    parser.add_argument('document_class', help='importable path package.module.Class')
+    parser.add_argument('files', nargs='+', help='NDJSON files, one document per line')
+    parser.add_argument('-w', '--workers', type=int, default=multiprocessing.cpu_count(),
+        help='worker processes (default: number of CPUs)')
+    parser.add_argument('-n', '--samples', type=int, default=5,
+        help='sample line numbers reported per field (default: 5)')
+    args = parser.parse_args(argv)
+
+    # fail early if the class can not be imported
+    load_class(args.document_class)
+
+    pool = multiprocessing.Pool(args.workers) if args.workers > 1 else None
+    failed = False
+    try:
+        for path in args.files:
+            records, failures, sample_lines = check_file(args.document_class, path,
+                args.workers, args.samples, pool)
+            report(path, records, failures, sample_lines, out)
+            failed = failed or bool(failures)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
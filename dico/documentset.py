@@ -0,0 +1,207 @@
+"""
+    In memory set of Documents with secondary indexes
+
+    >>> users = DocumentSet(hash_indexes=['email', 'tags'], sorted_indexes=['age'])
+    >>> users.add(user)
+    >>> users.find('email', 'bob@sponge.com')
+    >>> users.range('age', 18, 30)
+
+    Indexes are kept current through the change notifications of the documents:
+    a reassigned field or a mutated list marks the document, it is indexed
+    again on the next lookup. The entries of a ListField are indexed one by one.
+"""
+from bisect import bisect_left, bisect_right
+
+from . import (DateTimeField, EmbeddedDocumentField, FloatField, IntegerField,
+               ListField, _SEQUENCES)
+
+_SORTABLE_FIELDS = (IntegerField, FloatField, DateTimeField)
+
+
+def _keys(document, field_name):
+    """ return the index keys of a document field
+    """
+    value = getattr(document, field_name)
+    if isinstance(value, _SEQUENCES):
+        return tuple(value)
+    return (value,)
+
+
+class DocumentSet(object):
+    """
+        set of Documents of document_class with hash indexes (find)
+        and sorted indexes on IntegerField, FloatField, DateTimeField (range)
+        a document can be in several sets
+    """
+    def __init__(self, document_class=None, documents=(), hash_indexes=(), sorted_indexes=()):
+        self.document_class = document_class
+        self._documents = set()
+        # field_name: {key: set of documents}
+        self._hash_indexes = {}
+        # field_name: ([sorted keys], [documents in the same order])
+        self._sorted_indexes = {}
+        # document: {field_name: indexed keys}
+        self._indexed = {}
+        # documents changed since their last indexing
+        self._pending = set()
+        for field_name in hash_indexes:
+            self.add_index(field_name)
+        for field_name in sorted_indexes:
+            self.add_index(field_name, sorted=True)
+        for document in documents:
+            self.add(document)
+
+    def __len__(self):
+        return len(self._documents)
+
+    def __iter__(self):
+        return iter(list(self._documents))
+
+    def __contains__(self, document):
+        return document in self._documents
+
+    def _field(self, field_name):
+        field = None
+        if self.document_class is not None:
+            field = self.document_class._fields.get(field_name)
+            if field is None:
+                raise AttributeError('%s is not a field of %s' %
+                    (field_name, self.document_class.__name__))
+        return field
+
+    def add_index(self, field_name, sorted=False):
+        """ index field_name of the documents, sorted for range()
+            only IntegerField, FloatField and DateTimeField can be sorted
+            EmbeddedDocumentField can not be indexed
+        """
+        field = self._field(field_name)
+        entry_field = field.subfield if isinstance(field, ListField) else field
+        if isinstance(entry_field, EmbeddedDocumentField):
+            raise AttributeError('%s holds documents and can not be indexed' % field_name)
+        if sorted and field is not None and not isinstance(field, _SORTABLE_FIELDS):
+            raise AttributeError('%s can not be sorted' % field_name)
+        # the other indexes are brought up to date before
+        self._reindex()
+        for document in self._documents:
+            self._unindex(document)
+        if sorted:
+            self._sorted_indexes[field_name] = ([], [])
+        else:
+            self._hash_indexes[field_name] = {}
+        for document in self._documents:
+            self._index(document)
+
+    def add(self, document):
+        if self.document_class is not None and not isinstance(document, self.document_class):
+            raise TypeError('DocumentSet only accepts %s' % self.document_class.__name__)
+        if document in self._documents:
+            return
+        self._documents.add(document)
+        document._add_watcher(self)
+        self._indexed[document] = {}
+        self._index(document)
+
+    def discard(self, document):
+        if document not in self._documents:
+            return
+        self._unindex(document)
+        self._pending.discard(document)
+        del self._indexed[document]
+        self._documents.remove(document)
+        document._remove_watcher(self)
+
+    def remove(self, document):
+        if document not in self._documents:
+            raise KeyError(document)
+        self.discard(document)
+
+    def clear(self):
+        for document in list(self._documents):
+            self.discard(document)
+
+    def find(self, field_name, value):
+        """ return the list of documents whose field_name is or contains value
+        """
+        self._reindex()
+        index = self._hash_indexes.get(field_name)
+        if index is not None:
+            return list(index.get(value, ()))
+        return [document for document in self._documents
+                if value in _keys(document, field_name)]
+
+    def range(self, field_name, low=None, high=None, include_low=True, include_high=False):
+        """ return the documents with field_name between low and high in order
+            None is unbounded, documents without value are never returned
+            a document with several entries in range is returned once, at the first
+        """
+        self._reindex()
+        if field_name not in self._sorted_indexes:
+            raise AttributeError('%s has no sorted index' % field_name)
+        keys, documents = self._sorted_indexes[field_name]
+        start = 0
+        if low is not None:
+            start = (bisect_left if include_low else bisect_right)(keys, low)
+        end = len(keys)
+        if high is not None:
+            end = (bisect_right if include_high else bisect_left)(keys, high)
+        found = documents[start:end]
+        if len(set(found)) < len(found):
+            seen = set()
+            found = [document for document in found
+                     if document not in seen and not seen.add(document)]
+        return found
+
+    def _document_changed(self, document, field_name):
+        """ called by BaseField._changed before the new value is set
+            the document is indexed again on the next lookup
+        """
+        if field_name in self._hash_indexes or field_name in self._sorted_indexes:
+            self._pending.add(document)
+
+    def _reindex(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, set()
+        for document in pending:
+            self._unindex(document)
+            self._index(document)
+
+    def _index(self, document):
+        indexed = self._indexed[document]
+        for field_name in set(self._hash_indexes) | set(self._sorted_indexes):
+            keys = _keys(document, field_name)
+            indexed[field_name] = keys
+            if field_name in self._hash_indexes:
+                index = self._hash_indexes[field_name]
+                for key in keys:
+                    index.setdefault(key, set()).add(document)
+            if field_name in self._sorted_indexes:
+                sorted_keys, documents = self._sorted_indexes[field_name]
+                for key in keys:
+                    if key is not None:
+                        position = bisect_right(sorted_keys, key)
+                        sorted_keys.insert(position, key)
+                        documents.insert(position, document)
+
+    def _unindex(self, document):
+        indexed = self._indexed[document]
+        for field_name, keys in indexed.items():
+            if field_name in self._hash_indexes:
+                index = self._hash_indexes[field_name]
+                for key in keys:
+                    documents = index.get(key)
+                    if documents is not None:
+                        documents.discard(document)
+                        if not documents:
+                            del index[key]
+            if field_name in self._sorted_indexes:
+                sorted_keys, documents = self._sorted_indexes[field_name]
+                for key in keys:
+                    if key is None:
+                        continue
+                    position = bisect_left(sorted_keys, key)
+                    while documents[position] is not document:
+                        position += 1
+                    del sorted_keys[position]
+                    del documents[position]
+        indexed.clear()
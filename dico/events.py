@@ -0,0 +1,91 @@
+"""
+    Coalesced change events
+
+    >>> observer = ChangeObserver(lambda document, fields: cache.invalidate(document))
+    >>> observer.subscribe(User)          # every User
+    >>> observer.subscribe(some_document) # a single document
+    >>> user.name = 'Bob'; user.tags.append('admin')
+    >>> observer.flush()                  # callback(user, frozenset(['name', 'tags']))
+
+    Events are fed by the modification tracking of the documents (field
+    assignments, list changes, changes in embedded documents reported on the
+    field holding them) and kept until flush(), one per document.
+"""
+from collections import OrderedDict
+
+from . import Document, DocumentMetaClass, _clear_propagated, _watched_classes
+
+
+def _subclasses(document_class):
+    for subclass in document_class.__subclasses__():
+        yield subclass
+        for nested in _subclasses(subclass):
+            yield nested
+
+
+class ChangeObserver(object):
+    """
+        subscribe to documents or Document classes, subclasses included
+        flush() calls callback(document, changed fields) once per changed document
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self._pending = OrderedDict()
+
+    def subscribe(self, target):
+        """ target is a document or a Document class
+        """
+        if isinstance(target, Document):
+            if not target._has_watcher(self):
+                target._add_watcher(self)
+            # earlier changes of embedded documents must not stop the next ones
+            _clear_propagated(target)
+        elif isinstance(target, DocumentMetaClass):
+            for document_class in [target] + list(_subclasses(target)):
+                # subclasses without watchers of their own see the ones of target
+                if document_class is target or '_class_watchers' in document_class.__dict__:
+                    if self not in document_class._class_watchers:
+                        document_class._class_watchers += (self,)
+                        _watched_classes.add(document_class)
+        else:
+            raise TypeError('subscribe only accepts a Document or a Document class')
+
+    def unsubscribe(self, target):
+        if isinstance(target, Document):
+            if target._has_watcher(self):
+                target._remove_watcher(self)
+        elif isinstance(target, DocumentMetaClass):
+            for document_class in [target] + list(_subclasses(target)):
+                if '_class_watchers' in document_class.__dict__:
+                    document_class._class_watchers = tuple(watcher for watcher in
+                        document_class._class_watchers if watcher is not self)
+                    if not document_class._class_watchers:
+                        _watched_classes.discard(document_class)
+
+    def _document_changed(self, document, field_name):
+        """ called by BaseField._changed
+        """
+        fields = self._pending.get(document)
+        if fields is None:
+            self._pending[document] = fields = set()
+        fields.add(field_name)
+
+    def pending(self):
+        """ return the number of documents with changes not flushed
+        """
+        return len(self._pending)
+
+    def flush(self):
+        """ call callback for each changed document since the last flush
+            return the list of (document, frozenset of changed fields)
+        """
+        events, self._pending = self._pending, OrderedDict()
+        flushed = []
+        for document, fields in events.items():
+            # changes inside embedded documents have to reach document again
+            _clear_propagated(document)
+            flushed.append((document, frozenset(fields)))
+        if self.callback is not None:
+            for document, fields in flushed:
+                self.callback(document, fields)
+        return flushed
@@ -1,16 +1,141 @@
-try:
-    import bson.objectid
-except ImportError:
-    raise ImportError(
-        'Using the ObjectIdField requires Pymongo. '
-    )
-
 from . import BaseField, Document, rename_field
+from collections import OrderedDict
 from functools import partial
 
+# bson is imported on first use, it is slow to import
+_ObjectId = None
+
+
+def _object_id_class():
+    global _ObjectId
+    if _ObjectId is None:
+        try:
+            from bson.objectid import ObjectId
+        except ImportError:
+            raise ImportError(
+                'Using the ObjectIdField requires Pymongo. '
+            )
+        _ObjectId = ObjectId
+    return _ObjectId
+
 
 class ObjectIdField(BaseField):
     def _validate(self, value):
-        if not isinstance(value, (bson.objectid.ObjectId)):
+        if not isinstance(value, _ObjectId or _object_id_class()):
             return False
         return True
+
+    def _coerce(self, value):
+        if isinstance(value, basestring) and len(value) == 24:
+            object_id_class = _ObjectId or _object_id_class()
+            if object_id_class.is_valid(value):
+                return object_id_class(value)
+        return value
+
+
+class IdentityMap(object):
+    """
+        Documents loaded in a scope (a request, a job) keyed by class and _id
+        loading the same _id again returns the same instance
+        without building and validating it again
+
+        with more than max_size documents the least recently used clean
+        documents are evicted, modified documents are kept until
+        discard() or clear() so their changes are not lost silently
+        usable as a context manager, the map is cleared on exit
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._documents = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._documents)
+
+    def __contains__(self, key):
+        return key in self._documents
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.clear()
+
+    def get(self, document_class, _id):
+        """ return the document of document_class with _id or None
+        """
+        key = (document_class, _id)
+        document = self._documents.pop(key, None)
+        if document is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # most recently used last
+        self._documents[key] = document
+        return document
+
+    def add(self, document, _id, document_class=None):
+        """ add document with _id, replacing a previous clean one
+            document_class is the class it is looked up with, its class by default
+            raise ValueError if another document with _id has modified fields
+        """
+        key = (document_class or document.__class__, _id)
+        previous = self._documents.pop(key, None)
+        if previous is not None and previous is not document and previous.modified_fields():
+            self._documents[key] = previous
+            raise ValueError('%s %r is modified, discard() it before adding another one'
+                % (key[0].__name__, _id))
+        self._documents[key] = document
+        self._evict(key)
+        return document
+
+    def load(self, document_class, raw):
+        """ return the document of raw['_id'] if already loaded
+            otherwise build it with document_class.from_dict(raw) and add it
+            raw from a projection builds a partial document, it is returned as is
+            to later loads of the same _id
+        """
+        _id = raw['_id']
+        document = self.get(document_class, _id)
+        if document is None:
+            document = self.add(document_class.from_dict(raw), _id, document_class)
+        return document
+
+    def discard(self, document_class, _id):
+        """ forget the document of document_class with _id, modified or not
+        """
+        self._documents.pop((document_class, _id), None)
+
+    def clear(self):
+        self._documents.clear()
+
+    def dirty(self):
+        """ return the documents with modified fields
+        """
+        return [document for document in self._documents.values()
+                if document.modified_fields()]
+
+    def stats(self):
+        return {'size': len(self._documents), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+    def _evict(self, added):
+        """ forget the least recently used clean documents over max_size
+            the document just added is kept
+        """
+        excess = len(self._documents) - self.max_size
+        if excess <= 0:
+            return
+        documents = self._documents
+        evicted = []
+        # oldest first, stops as soon as enough clean documents are found
+        for key in documents:
+            if key != added and not documents[key].modified_fields():
+                evicted.append(key)
+                if len(evicted) == excess:
+                    break
+        for key in evicted:
+            del documents[key]
+        self.evictions += len(evicted)
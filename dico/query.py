@@ -0,0 +1,302 @@
+"""
+    Mongo filters over in memory Documents
+
+    >>> is_adult_admin = dico.query.compile({'age': {'$gte': 18}, 'tags': 'admin'}, User)
+    >>> [user for user in users if is_adult_admin(user)]
+    >>> dico.query.find(document_set, {'age': {'$gte': 18}, 'tags': 'admin'})
+
+    compile() turns a filter into a predicate once, dotted paths go through
+    EmbeddedDocumentField and ListField items like in mongo, a condition on a
+    list matches if the list or one of its entries matches.
+    find() uses the indexes of a DocumentSet to avoid a full scan.
+
+    Supported: $eq $ne $gt $gte $lt $lte $in $nin $exists $regex $options
+    $size $all $elemMatch $not $and $or $nor
+"""
+import re
+
+from . import Document, EmbeddedDocumentField, ListField, _SEQUENCES
+from .documentset import DocumentSet
+
+_NUMBERS = (int, long, float)
+_RANGES = ('$gt', '$gte', '$lt', '$lte')
+
+
+def _plain(value):
+    """ return the dict or list value of a document or list, to compare with a filter
+    """
+    if isinstance(value, Document):
+        plain = {}
+        for field_name in value._fields:
+            entry = getattr(value, field_name)
+            if entry is not None:
+                plain[field_name] = _plain(entry)
+        return plain
+    if isinstance(value, _SEQUENCES):
+        return [_plain(entry) for entry in value]
+    return value
+
+
+def _expand(values):
+    """ values reached by a path and the entries of the lists among them
+    """
+    for value in values:
+        yield value
+        if isinstance(value, _SEQUENCES):
+            for entry in value:
+                yield entry
+
+
+def _comparable(value, other):
+    """ mongo only orders values of the same kind
+    """
+    if isinstance(value, _NUMBERS) and not isinstance(value, bool):
+        return isinstance(other, _NUMBERS) and not isinstance(other, bool)
+    if isinstance(value, basestring):
+        return isinstance(other, basestring)
+    return type(value) is type(other)
+
+
+def _equals(value, other):
+    if isinstance(value, (Document,) + _SEQUENCES):
+        return _plain(value) == other
+    return value == other
+
+
+def _path_field(document_class, path):
+    """ return the field at the end of a dotted path, None if unknown
+        raise AttributeError for a path that is not in the schema
+    """
+    field = None
+    for part in path.split('.'):
+        if field is not None:
+            if isinstance(field, ListField):
+                if part.isdigit():
+                    field = field.subfield
+                    continue
+                field = field.subfield
+            if not isinstance(field, EmbeddedDocumentField):
+                raise AttributeError('%s goes through a field without documents' % path)
+            document_class = field.field_type
+        if document_class is None:
+            return None
+        field = document_class._fields.get(part)
+        if field is None:
+            if hasattr(document_class, part):
+                # a property, resolved at run time
+                return None
+            raise AttributeError('%s is not a field of %s' % (part, document_class.__name__))
+    return field
+
+
+def _getter(path):
+    """ return a function giving the list of values reached by path from a document
+    """
+    parts = path.split('.')
+
+    def get(document):
+        values = [document]
+        for part in parts:
+            reached = []
+            for value in values:
+                if isinstance(value, _SEQUENCES):
+                    if part.isdigit():
+                        index = int(part)
+                        if index < len(value):
+                            reached.append(value[index])
+                        continue
+                    # documents of a list, one level like mongo
+                    for entry in value:
+                        if isinstance(entry, Document):
+                            entry = getattr(entry, part, None)
+                            if entry is not None:
+                                reached.append(entry)
+                    continue
+                if isinstance(value, Document):
+                    value = getattr(value, part, None)
+                elif isinstance(value, dict):
+                    value = value.get(part)
+                else:
+                    continue
+                if value is not None:
+                    reached.append(value)
+            values = reached
+            if not values:
+                break
+        return values
+    return get
+
+
+def _condition(field, operator, argument):
+    """ return a function testing the values reached by a path
+    """
+    if operator == '$eq':
+        if argument is None:
+            # paths reaching None give no value
+            return lambda values: not values
+        if isinstance(argument, dict) or isinstance(argument, list):
+            return lambda values: any(_equals(value, argument) for value in _expand(values))
+        return lambda values: any(value == argument for value in _expand(values))
+    if operator == '$ne':
+        equals = _condition(field, '$eq', argument)
+        return lambda values: not equals(values)
+    if operator in _RANGES:
+        compare = {
+            '$gt': lambda value: value > argument,
+            '$gte': lambda value: value >= argument,
+            '$lt': lambda value: value < argument,
+            '$lte': lambda value: value <= argument,
+        }[operator]
+        return lambda values: any(_comparable(value, argument) and compare(value)
+                                  for value in _expand(values))
+    if operator == '$in':
+        if all(not isinstance(entry, (dict, list, type(None))) for entry in argument):
+            entries = set(argument)
+            return lambda values: any(not isinstance(value, (Document, dict) + _SEQUENCES) and
+                                      value in entries for value in _expand(values))
+        tests = [_condition(field, '$eq', entry) for entry in argument]
+        return lambda values: any(test(values) for test in tests)
+    if operator == '$nin':
+        contains = _condition(field, '$in', argument)
+        return lambda values: not contains(values)
+    if operator == '$exists':
+        if argument:
+            return lambda values: bool(values)
+        return lambda values: not values
+    if operator == '$regex':
+        regex = argument if hasattr(argument, 'search') else re.compile(argument)
+        return lambda values: any(isinstance(value, basestring) and regex.search(value)
+                                  for value in _expand(values))
+    if operator == '$size':
+        return lambda values: any(isinstance(value, _SEQUENCES) and len(value) == argument
+                                  for value in values)
+    if operator == '$all':
+        tests = [_condition(field, '$eq', entry) for entry in argument]
+        return lambda values: bool(argument) and all(test(values) for test in tests)
+    if operator == '$elemMatch':
+        subfield = field.subfield if isinstance(field, ListField) else None
+        if isinstance(subfield, EmbeddedDocumentField):
+            match = compile(argument, subfield.field_type)
+        elif any(key.startswith('$') for key in argument):
+            match_values = _operators(subfield, argument)
+            match = lambda entry: match_values([entry])
+        else:
+            match = compile(argument)
+        return lambda values: any(isinstance(value, _SEQUENCES) and
+                                  any(match(entry) for entry in value)
+                                  for value in values)
+    if operator == '$not':
+        if hasattr(argument, 'search'):
+            test = _condition(field, '$regex', argument)
+        else:
+            test = _operators(field, argument)
+        return lambda values: not test(values)
+    raise ValueError('Unknown operator %s' % operator)
+
+
+def _operators(field, conditions):
+    """ return a function testing values against a dict of operators
+    """
+    conditions = dict(conditions)
+    options = conditions.pop('$options', None)
+    if options is not None and '$regex' in conditions:
+        flags = 0
+        for option in options:
+            flags |= {'i': re.IGNORECASE, 'm': re.MULTILINE, 's': re.DOTALL,
+                      'x': re.VERBOSE}[option]
+        conditions['$regex'] = re.compile(conditions['$regex'], flags)
+    tests = [_condition(field, operator, argument)
+             for operator, argument in conditions.items()]
+    if len(tests) == 1:
+        return tests[0]
+    return lambda values: all(test(values) for test in tests)
+
+
+def _is_operators(value):
+    return isinstance(value, dict) and bool(value) and \
+        all(key.startswith('$') for key in value)
+
+
+def compile(spec, document_class=None):
+    """ return a predicate function(document) for a mongo filter
+        with document_class the paths are checked against its schema
+        raise AttributeError for an unknown path, ValueError for an unknown operator
+    """
+    tests = []
+    for key, value in spec.items():
+        if key in ('$and', '$or', '$nor'):
+            predicates = [compile(sub_spec, document_class) for sub_spec in value]
+            if key == '$and':
+                tests.append(lambda document, predicates=predicates:
+                             all(predicate(document) for predicate in predicates))
+            elif key == '$or':
+                tests.append(lambda document, predicates=predicates:
+                             any(predicate(document) for predicate in predicates))
+            else:
+                tests.append(lambda document, predicates=predicates:
+                             not any(predicate(document) for predicate in predicates))
+            continue
+        if key.startswith('$'):
+            raise ValueError('Unknown operator %s' % key)
+        field = _path_field(document_class, key) if document_class is not None else None
+        if _is_operators(value):
+            test = _operators(field, value)
+        elif hasattr(value, 'search'):
+            test = _condition(field, '$regex', value)
+        else:
+            test = _condition(field, '$eq', value)
+        tests.append(lambda document, get=_getter(key), test=test: test(get(document)))
+
+    if len(tests) == 1:
+        return tests[0]
+    return lambda document: all(test(document) for test in tests)
+
+
+def _candidates(document_set, spec):
+    """ return the documents of an index matching a condition of spec
+        the smallest found, None if no condition can use an index
+    """
+    best = None
+    for key, value in spec.items():
+        candidates = None
+        hashed = key in document_set._hash_indexes
+        if _is_operators(value):
+            if hashed and '$eq' in value and not isinstance(value['$eq'], (dict, list)):
+                candidates = document_set.find(key, value['$eq'])
+            elif hashed and '$in' in value and \
+                    not any(isinstance(entry, (dict, list)) for entry in value['$in']):
+                found = set()
+                for entry in value['$in']:
+                    found.update(document_set.find(key, entry))
+                candidates = list(found)
+            elif key in document_set._sorted_indexes and any(op in value for op in _RANGES):
+                low = value.get('$gte', value.get('$gt'))
+                high = value.get('$lte', value.get('$lt'))
+                document_set._reindex()
+                keys = document_set._sorted_indexes[key][0]
+                # a bound of another kind than the indexed values matches nothing
+                # in the predicate and can not be compared with them
+                if not keys:
+                    candidates = []
+                elif all(bound is None or _comparable(bound, keys[0]) for bound in (low, high)):
+                    # bounds included, the predicate filters the candidates again
+                    candidates = document_set.range(key, low, high, include_high=True)
+        elif hashed and not isinstance(value, (dict, list)) and value is not None \
+                and not hasattr(value, 'search'):
+            candidates = document_set.find(key, value)
+        if candidates is not None and (best is None or len(candidates) < len(best)):
+            best = candidates
+    return best
+
+
+def find(documents, spec, document_class=None):
+    """ return the list of documents matching spec
+        documents can be any iterable, a DocumentSet index is used when possible
+    """
+    if isinstance(documents, DocumentSet):
+        document_class = document_class or documents.document_class
+        candidates = _candidates(documents, spec)
+        if candidates is not None:
+            documents = candidates
+    predicate = compile(spec, document_class)
+    return [document for document in documents if predicate(document)]
@@ -0,0 +1,178 @@
+"""
+    Read only on-disk store of Documents of one class
+
+    >>> dico.store.write('countries.dico', countries, key='code')
+    >>> with dico.store.Store(Country, 'countries.dico') as countries:
+    ...     countries.get('FR').name
+
+    The file holds the dict_for_save() of each document as compact JSON,
+    a table of record offsets and a table of the keys sorted with their position,
+    it is opened with mmap so only the records read are loaded and the page cache
+    is shared between processes, get() binary searches the keys in place.
+    Values JSON can not hold (datetime, ObjectId) are written as strings and
+    converted back with the _coerce() of their field.
+"""
+import datetime
+import json
+import mmap
+import os
+import struct
+
+from . import EmbeddedDocumentField, ListField, _input_fields
+
+MAGIC = b'DICOSTR2'
+# count, offsets table position, keys table position, key width
+_FOOTER = struct.Struct('<4Q')
+_OFFSET = struct.Struct('<Q')
+# a key is its compact JSON padded with NUL to the key width, JSON never holds
+# a raw NUL so padded keys compare like the keys, followed by its position
+_PADDING = b'\0'
+_RECORD = struct.Struct('<2Q')
+
+
+def _encode(value):
+    """ json default for the values dict_for_save() can hold
+    """
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(',', ':'), default=_encode).encode('utf-8')
+
+
+def _decode(document_class, raw):
+    """ convert in place the strings written by _encode back to their field type
+    """
+    input_fields = _input_fields(document_class)
+    for key, value in raw.items():
+        field = input_fields.get(key)
+        if field is None or value is None:
+            continue
+        if isinstance(field, EmbeddedDocumentField):
+            _decode(field.field_type, value)
+        elif isinstance(field, ListField):
+            subfield = field.subfield
+            if isinstance(subfield, EmbeddedDocumentField):
+                for entry in value:
+                    _decode(subfield.field_type, entry)
+            elif hasattr(subfield, '_coerce'):
+                raw[key] = [subfield._coerce(entry) for entry in value]
+        elif hasattr(field, '_coerce'):
+            raw[key] = field._coerce(value)
+    return raw
+
+
+def write(path, documents, key=None):
+    """ write documents to path, replacing it atomically
+        key is the name of a unique field to get documents by with Store.get
+        raise ValidationException if a document is not valid
+    """
+    offsets = []
+    keys = []
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as store:
+        store.write(MAGIC)
+        position = len(MAGIC)
+        for document in documents:
+            record = _dumps(document.dict_for_save())
+            offsets.append(position)
+            store.write(record)
+            position += len(record)
+            if key is not None:
+                keys.append((_dumps(getattr(document, key)), len(offsets) - 1))
+        offsets.append(position)
+        for offset in offsets:
+            store.write(_OFFSET.pack(offset))
+        keys.sort()
+        width = max([len(stored) for stored, _ in keys] or [0])
+        for stored, key_position in keys:
+            store.write(stored.ljust(width, _PADDING))
+            store.write(_OFFSET.pack(key_position))
+        store.write(_FOOTER.pack(len(offsets) - 1, position,
+            position + _OFFSET.size * len(offsets), width))
+    os.rename(tmp_path, path)
+
+
+class Store(object):
+    """
+        documents of document_class written by write()
+        store[position] and store.get(key) read and build a single document
+    """
+    def __init__(self, document_class, path):
+        self.document_class = document_class
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError('%s is not a dico store' % path)
+        self._count, self._offsets_pos, self._keys_pos, self._key_width = \
+            _FOOTER.unpack_from(self._mmap, len(self._mmap) - _FOOTER.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += self._count
+        if not 0 <= position < self._count:
+            raise IndexError('store index out of range')
+        start, end = _RECORD.unpack_from(self._mmap,
+            self._offsets_pos + _OFFSET.size * position)
+        raw = json.loads(self._mmap[start:end].decode('utf-8'))
+        return self.document_class.from_dict(_decode(self.document_class, raw))
+
+    def __iter__(self):
+        for position in range(self._count):
+            yield self[position]
+
+    def _key_entry(self, index):
+        """ return the padded key and the position of the index-th sorted key
+        """
+        start = self._keys_pos + (self._key_width + _OFFSET.size) * index
+        end = start + self._key_width
+        return self._mmap[start:end], _OFFSET.unpack_from(self._mmap, end)[0]
+
+    def keys(self):
+        """ return the keys in position order, empty if written without key
+        """
+        if not self._key_width:
+            return []
+        keys = [None] * self._count
+        for index in range(self._count):
+            stored, position = self._key_entry(index)
+            keys[position] = json.loads(stored.rstrip(_PADDING).decode('utf-8'))
+        return keys
+
+    def get(self, key, default=None):
+        """ return the document of key or default
+        """
+        stored = _dumps(key)
+        if not self._key_width or len(stored) > self._key_width:
+            return default
+        stored = stored.ljust(self._key_width, _PADDING)
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key_entry(middle)[0] < stored:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self._count:
+            return default
+        found, position = self._key_entry(low)
+        if found != stored:
+            return default
+        return self[position]
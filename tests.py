@@ -1,12 +1,26 @@
 import dico
 import unittest
 import re
+import array
 import datetime
 import dico.mongo
+import dico.aio
 from bson.objectid import ObjectId
 import random
+import os
+import tempfile
+from StringIO import StringIO
 from functools import partial
 
+import dico.check
+import dico.store
+
+
+class CheckedUser(dico.Document):
+    id = dico.mongo.ObjectIdField(required=True, db_name='_id')
+    email = dico.EmailField(required=True)
+    age = dico.IntegerField()
+
 class TestDico(unittest.TestCase):
     def setUp(self):
         pass
@@ -854,6 +868,1451 @@ class TestDico(unittest.TestCase):
         user.url = ''
         self.assertTrue(user.validate())
 
+    def test_diff(self):
+        class Token(dico.Document):
+            secret = dico.StringField()
+            id = dico.IntegerField()
+
+        class User(dico.Document):
+            id = dico.IntegerField()
+            name = dico.StringField()
+            token = dico.EmbeddedDocumentField(Token)
+            tokens = dico.ListField(dico.EmbeddedDocumentField(Token))
+            tags = dico.ListField(dico.StringField())
+
+        user_dict = {'id': 1, 'name': 'Bob', 'token': {'secret': 'a', 'id': 1},
+            'tokens': [{'secret': 'b', 'id': 2}], 'tags': ['x', 'y']}
+        user = User(**user_dict)
+        self.assertEqual(user.diff(User(**user_dict)), {})
+
+        other = User(**user_dict)
+        other.name = None
+        other.token.secret = 'c'
+        other.tokens[0].id = 3
+        other.tokens.append(Token(secret='d', id=4))
+        other.tags[1] = 'z'
+        delta = user.diff(other)
+        # tokens has changed and new items: set entirely, mongo refuses $set and $push on it
+        self.assertEqual(delta, {
+            '$set': {'token.secret': 'c', 'tags.1': 'z',
+                     'tokens': [{'secret': 'b', 'id': 3}, {'secret': 'd', 'id': 4}]},
+            '$unset': {'name': ''},
+        })
+        other_tags = User(**user_dict)
+        other_tags.tags.append('z')
+        self.assertEqual(user.diff(other_tags), {'$push': {'tags': {'$each': ['z']}}})
+
+        user.apply_diff(delta)
+        self.assertEqual(user.diff(other), {})
+        self.assertIsNone(user.name)
+        self.assertIsInstance(user.tokens[1], Token)
+        self.assertIs(user.tokens[1]._parent, user)
+        self.assertEqual(user.modified_fields(), set(['name', 'token', 'tokens', 'tags']))
+
+        # shorter lists and new embedded documents are set entirely
+        other = User(**user_dict)
+        other.tags = ['x']
+        other.token = None
+        user = User(id=1, name='Bob', tokens=[{'secret': 'b', 'id': 2}], tags=['x', 'y'])
+        delta = user.diff(other)
+        self.assertEqual(delta, {'$set': {'tags': ['x']}})
+        user.apply_diff(user.diff(User(**user_dict)))
+        self.assertIsInstance(user.token, Token)
+        self.assertEqual(user.token.secret, 'a')
+
+        class Car(dico.Document):
+            id = dico.IntegerField()
+        self.assertRaises(TypeError, user.diff, Car())
+
+        # paths use the stored names like the embedded values
+        class Wheel(dico.Document):
+            size = dico.IntegerField(db_name='s')
+
+        class Truck(dico.Document):
+            id = dico.IntegerField(db_name='_id')
+            wheel = dico.EmbeddedDocumentField(Wheel, db_name='w')
+
+        truck = Truck(id=1, wheel={'size': 1})
+        delta = truck.diff(Truck(id=2, wheel={'size': 2}))
+        self.assertEqual(delta, {'$set': {'_id': 2, 'w.s': 2}})
+        truck.apply_diff(delta)
+        self.assertEqual((truck.id, truck.wheel.size), (2, 2))
+
+    def test_track_snapshot(self):
+        class Token(dico.Document):
+            secret = dico.StringField()
+
+        class User(dico.Document):
+            id = dico.IntegerField()
+            name = dico.StringField()
+            token = dico.EmbeddedDocumentField(Token)
+            tokens = dico.ListField(dico.EmbeddedDocumentField(Token))
+            tags = dico.ListField(dico.StringField())
+
+            track_snapshot = True
+
+        user_dict = {'id': 1, 'name': 'Bob', 'token': {'secret': 'a'},
+            'tokens': [{'secret': 'b'}], 'tags': ['x']}
+        user = User(**user_dict)
+
+        # merge an identical payload: nothing to write
+        for key, value in User(**user_dict).dict_for_save().items():
+            setattr(user, key, value)
+        self.assertEqual(user.modified_fields(), set())
+        self.assertEqual(user.dict_for_modified_fields(), {})
+
+        user.tags.append('y')
+        user.tokens[0].secret = 'c'
+        user.token.secret = 'd'
+        user.name = 'Sponge'
+        self.assertEqual(user.modified_fields(), set(['tags', 'tokens', 'token', 'name']))
+
+        # going back to the loaded values
+        user.tags.pop()
+        user.tokens[0].secret = 'b'
+        user.token = Token(secret='a')
+        user.name = 'Bob'
+        self.assertEqual(user.modified_fields(), set())
+
+        user.tags += ['z']
+        self.assertEqual(user.modified_fields(), set(['tags']))
+        self.assertEqual(user.dict_for_modified_fields(), {'tags': ['x', 'z']})
+
+        user.id = 2
+        user.tags.sort(reverse=True)
+        self.assertEqual(user.modified_fields(), set(['tags', 'id']))
+
+        class Car(dico.Document):
+            name = dico.StringField()
+
+        car = Car(name='Peugeot')
+        car.name = 'Peugeot'
+        self.assertEqual(car.modified_fields(), set(['name']))
+
+    def test_list_pop(self):
+        class User(dico.Document):
+            tags = dico.ListField(dico.StringField())
+
+        user = User(tags=['', 'a'])
+        self.assertEqual(user.tags.pop(0), '')
+        self.assertIn('tags', user.modified_fields())
+        user = User()
+        self.assertRaises(IndexError, user.tags.pop)
+        self.assertEqual(user.modified_fields(), set())
+
+    def test_db_name(self):
+        class Token(dico.Document):
+            secret = dico.StringField(db_name='s')
+
+        class MongoUser(dico.Document):
+            id = dico.mongo.ObjectIdField(required=True, default=ObjectId, db_name='_id')
+            name = dico.StringField()
+            token = dico.EmbeddedDocumentField(Token, db_name='t')
+
+        oid = ObjectId()
+        user = MongoUser(_id=oid, name='Bob', t={'s': 'abc'})
+        self.assertEqual(user.id, oid)
+        self.assertEqual(user.token.secret, 'abc')
+        self.assertEqual(user.dict_for_save(), {'_id': oid, 'name': 'Bob', 't': {'s': 'abc'}})
+        self.assertEqual(user.modified_fields(), set())
+
+        user = MongoUser(id=oid)
+        self.assertEqual(user.id, oid)
+        user.name = 'Sponge'
+        user.id = oid
+        self.assertEqual(user.dict_for_modified_fields(), {'_id': oid, 'name': 'Sponge'})
+
+        self.assertRaises(ValueError, MongoUser, id=oid, _id=oid)
+
+        # filters still apply after db_name
+        class User(dico.Document):
+            id = dico.IntegerField(db_name='_id')
+
+            pre_save_filter = [partial(dico.rename_field, '_id', 'uid')]
+
+        self.assertEqual(User(id=3).dict_for_save(), {'uid': 3})
+
+    def test_memory_layout(self):
+        class User(dico.Document):
+            id = dico.IntegerField()
+            name = dico.StringField()
+            tags = dico.ListField(dico.StringField())
+
+        user = User(id=1, tags=['a'])
+        self.assertIs(user.modified_fields(), User(id=2).modified_fields())
+        self.assertFalse(hasattr(user.tags, '__dict__'))
+        self.assertFalse(hasattr(user, '__dict__'))
+
+        user.name = 'Bob'
+        user.tags.append('b')
+        self.assertEqual(user.modified_fields(), set(['name', 'tags']))
+        self.assertTrue(user.validate())
+        self.assertEqual(user.modified_fields(), set(['name', 'tags']))
+        # caches, watchers and snapshots are only allocated when used
+        self.assertIsNone(user._extras)
+        user.content_hash()
+        self.assertIsNotNone(user._extras.cache)
+
+    def test_list_incremental_validation(self):
+        checked = []
+
+        class CountingField(dico.IntegerField):
+            def _validate(self, value):
+                checked.append(value)
+                return super(CountingField, self)._validate(value)
+
+        class User(dico.Document):
+            friends = dico.ListField(CountingField(), max_length=10)
+
+        user = User(friends=range(5))
+        self.assertTrue(user.validate())
+        self.assertEqual(len(checked), 5)
+
+        del checked[:]
+        user.friends.append(5)
+        self.assertTrue(user.validate())
+        self.assertEqual(checked, [5])
+
+        del checked[:]
+        user.friends[2] = 'a'
+        self.assertFalse(user.validate())
+        self.assertEqual(checked, ['a'])
+        user.friends.pop(2)
+        self.assertTrue(user.validate())
+        self.assertEqual(checked, ['a', 3, 4, 5])
+
+        del checked[:]
+        user.friends.insert(1, 'b')
+        self.assertFalse(user.validate())
+        user.friends.remove('b')
+        self.assertTrue(user.validate())
+        user.friends.reverse()
+        self.assertTrue(user.validate())
+        self.assertEqual(checked, ['b', 1, 3, 4, 5])
+
+        # max_length is still checked without looking at the entries
+        del checked[:]
+        user.friends.extend(range(10))
+        self.assertFalse(user.validate())
+        self.assertEqual(checked, [])
+
+        class Token(dico.Document):
+            secret = dico.StringField(required=True)
+
+        class Group(dico.Document):
+            tokens = dico.ListField(dico.EmbeddedDocumentField(Token))
+
+        group = Group(tokens=[{'secret': 'a'}, {'secret': 'b'}])
+        self.assertTrue(group.validate())
+        group.tokens[1].secret = None
+        self.assertFalse(group.validate())
+        group.tokens[1].secret = 'c'
+        self.assertTrue(group.validate())
+
+        # a list validated by another field is validated again
+        class Names(dico.Document):
+            names = dico.ListField(dico.StringField())
+
+        numbers = User(friends=[1, 2])
+        self.assertTrue(numbers.validate())
+        names = Names()
+        names.names = numbers.friends
+        self.assertFalse(names.validate())
+        names.names.append('a')
+        self.assertEqual(numbers.friends, [1, 2])
+        self.assertEqual(numbers.modified_fields(), set())
+
+        # lists of lists
+        class Matrix(dico.Document):
+            grid = dico.ListField(dico.ListField(dico.IntegerField()))
+            groups = dico.ListField(dico.ListField(dico.EmbeddedDocumentField(Token)))
+
+        matrix = Matrix(grid=[[1, 2], [3]], groups=[[{'secret': 'a'}]])
+        self.assertTrue(matrix.validate())
+        matrix.grid[0].append('bad')
+        self.assertFalse(matrix.validate())
+        matrix.grid[0].pop()
+        self.assertTrue(matrix.validate())
+        matrix.groups[0][0].secret = None
+        self.assertFalse(matrix.validate())
+        matrix.groups[0][0].secret = 'b'
+        self.assertTrue(matrix.validate())
+
+    def test_typed_list_field(self):
+        class Metrics(dico.Document):
+            counters = dico.ListField(dico.IntegerField(), typed=True, max_length=5)
+            values = dico.ListField(dico.FloatField(), typed=True)
+
+            track_snapshot = True
+
+        metrics = Metrics(counters=[1, 2, 3], values=[1.5, 2])
+        self.assertIsInstance(metrics.counters, dico.NotifyParentArray)
+        self.assertEqual(metrics.counters.typecode, 'l')
+        self.assertTrue(metrics.validate())
+        save_dict = metrics.dict_for_save()
+        self.assertEqual(save_dict, {'counters': [1, 2, 3], 'values': [1.5, 2.0]})
+        self.assertIs(type(save_dict['counters']), list)
+        self.assertEqual(metrics.modified_fields(), set())
+
+        metrics.counters.append(4)
+        self.assertEqual(metrics.modified_fields(), set(['counters']))
+        self.assertRaises(TypeError, metrics.counters.append, 'a')
+        self.assertRaises(TypeError, metrics.counters.append, 1.5)
+        metrics.counters.extend([5, 6])
+        self.assertFalse(metrics.validate())
+        metrics.counters.pop()
+        self.assertTrue(metrics.validate())
+        metrics.counters.remove(4)
+        metrics.counters.remove(5)
+        self.assertEqual(metrics.modified_fields(), set())
+
+        # rejected values leave the document untouched
+        metrics.mark_clean()
+        metrics.validate()
+        for method, args in [('append', ('a',)), ('insert', (0, 1.5)), ('extend', (['a'],)),
+                             ('__setitem__', (0, 'a')), ('remove', (42,)), ('pop', (10,)),
+                             ('fromlist', ([1, 'a'],))]:
+            self.assertRaises((TypeError, ValueError, IndexError),
+                getattr(metrics.counters, method), *args)
+        self.assertEqual(metrics.modified_fields(), set())
+        self.assertTrue(metrics._state & dico._VALID)
+
+        # entries loaded from bytes are tracked too
+        raw = array.array('l', [7]).tostring()
+        metrics.counters.fromstring(raw)
+        self.assertEqual(metrics.counters.tolist(), [1, 2, 3, 7])
+        self.assertEqual(metrics.modified_fields(), set(['counters']))
+
+        # default value and bad input kept as a list for validate()
+        self.assertIsInstance(Metrics().counters, dico.NotifyParentArray)
+        metrics = Metrics(counters=[1, 'a'])
+        self.assertFalse(metrics.validate())
+        metrics.counters = [1, 2]
+        self.assertTrue(metrics.validate())
+
+        other = Metrics(counters=[1, 3, 4])
+        self.assertEqual(metrics.diff(other), {'$set': {'counters': [1, 3, 4]}})
+        self.assertEqual(metrics.diff(Metrics(counters=[1, 2, 4])),
+            {'$push': {'counters': {'$each': [4]}}})
+        metrics.apply_diff(metrics.diff(other))
+        self.assertEqual(metrics.counters.tolist(), [1, 3, 4])
+
+        self.assertRaises(AttributeError, dico.ListField, dico.StringField(), typed=True)
+
+    def test_from_json(self):
+        class Token(dico.Document):
+            secret = dico.StringField()
+            id = dico.IntegerField(db_name='_id')
+
+        class User(dico.Document):
+            id = dico.IntegerField(aliases=['uid'])
+            name = dico.StringField()
+            token = dico.EmbeddedDocumentField(Token)
+            tokens = dico.ListField(dico.EmbeddedDocumentField(Token))
+            tags = dico.ListField(dico.StringField())
+
+        payload = b'{"uid": 1, "name": "Bob \\u00e9", "unknown": {"a": [1, 2]}, ' \
+            b'"token": {"secret": "a", "_id": 2}, "tags": ["x", "y"], ' \
+            b'"tokens": [{"secret": "b", "_id": 3}, {"secret": "c"}]}'
+        user = User.from_json(payload)
+        self.assertEqual(user.id, 1)
+        self.assertEqual(user.name, u'Bob \xe9')
+        self.assertIsInstance(user.token, Token)
+        self.assertIs(user.token._parent, user)
+        self.assertEqual(user.token.id, 2)
+        self.assertEqual([token.secret for token in user.tokens], ['b', 'c'])
+        self.assertIs(user.tokens[0]._parent, user)
+        self.assertEqual(user.tags, ['x', 'y'])
+        self.assertEqual(user.modified_fields(), set())
+        self.assertTrue(user.validate())
+
+        from io import BytesIO
+        self.assertEqual(User.from_json(BytesIO(payload)).dict_for_save(), user.dict_for_save())
+        self.assertEqual(User.from_json(u'{}').dict_for_save(), {'tags': [], 'tokens': []})
+        self.assertRaises(ValueError, User.from_json, b'{"id": 1')
+        self.assertRaises(ValueError, User.from_json, b'[1]')
+
+        stream = BytesIO(b' [' + b', '.join([payload] * 50) + b']\n')
+        users = list(User.iter_json(stream, chunk_size=7))
+        self.assertEqual(len(users), 50)
+        self.assertEqual(users[49].dict_for_save(), user.dict_for_save())
+
+        # cut in the middle of a number between two chunks
+        stream = BytesIO(b'[{"id": 12345}, {"id": 678}]')
+        self.assertEqual([u.id for u in User.iter_json(stream, chunk_size=12)], [12345, 678])
+        self.assertEqual(list(User.iter_json(BytesIO(b'[ ]'))), [])
+        self.assertRaises(ValueError, list, User.iter_json(BytesIO(b'[{"id": 1}, 2]')))
+        self.assertRaises(ValueError, list, User.iter_json(BytesIO(b'[{"id": 1}')))
+
+        # short reads ending inside a multibyte character
+        data = u'[{"name": "\u00e9t\u00e9"}, {"name": "\u20ac"}]'.encode('utf-8')
+        self.assertEqual([u.name for u in User.iter_json(BytesIO(data), chunk_size=1)],
+                         [u'\u00e9t\u00e9', u'\u20ac'])
+        self.assertEqual(User.from_json(BytesIO(data[1:data.index(b'}') + 1])).name,
+                         u'\u00e9t\u00e9')
+
+        # trailing data is refused like json.loads does
+        self.assertRaises(ValueError, User.from_json, '{"id": 1} trailing')
+        self.assertEqual(User.from_json('{"id": 1}\n ').id, 1)
+        self.assertRaises(ValueError, User.from_json, BytesIO(b'{"id": 1} {}'))
+        self.assertRaises(ValueError, list, User.iter_json(BytesIO(b'[{"id": 1}] x'), chunk_size=3))
+
+    def test_check(self):
+        lines = []
+        for i in range(100):
+            lines.append('{"_id": {"$oid": "500535541aebce0dfc0000%02d"}, '
+                '"email": "bob%d@sponge.com", "age": %d}' % (i, i, i))
+        lines[10] = '{"_id": {"$oid": "500535541aebce0dfc000010"}, "email": "bob"}'
+        lines[20] = '{"_id": {"$oid": "500535541aebce0dfc000020"}, "age": "a"}'
+        lines[30] = '{"email": "bob'
+        lines[40] = ''
+        fd, path = tempfile.mkstemp()
+        os.write(fd, '\n'.join(lines) + '\n')
+        os.close(fd)
+        class_path = '%s.CheckedUser' % CheckedUser.__module__
+        try:
+            records, failures, sample_lines = dico.check.check_file(class_path, path,
+                workers=4, min_chunk_size=100)
+            self.assertEqual(records, 99)
+            self.assertEqual(failures, {'email': 2, 'age': 1, '<json>': 1})
+            self.assertEqual(sample_lines, {'email': [11, 21], 'age': [21], '<json>': [31]})
+
+            out = StringIO()
+            self.assertEqual(dico.check.main(['-w', '2', class_path, path], out=out), 1)
+            self.assertIn('99 records, 4 failures', out.getvalue())
+            self.assertIn('lines 11, 21', out.getvalue())
+
+            fd, empty_path = tempfile.mkstemp()
+            os.close(fd)
+            out = StringIO()
+            self.assertEqual(dico.check.main(['-w', '1', class_path, empty_path], out=out), 0)
+            os.remove(empty_path)
+        finally:
+            os.remove(path)
+
+    def test_cache_dicts(self):
+        calls = []
+
+        class Token(dico.Document):
+            secret = dico.StringField()
+            public_fields = ['secret']
+
+        class User(dico.Document):
+            id = dico.IntegerField()
+            tags = dico.ListField(dico.StringField())
+            token = dico.EmbeddedDocumentField(Token)
+            tokens = dico.ListField(dico.EmbeddedDocumentField(Token))
+            public_fields = ['id', 'tags', 'token', 'count']
+            cache_dicts = True
+
+            @property
+            def count(self):
+                calls.append(1)
+                return len(self.tags)
+
+        user = User(id=1, tags=['a'], token={'secret': 'abc'}, tokens=[{'secret': 'def'}])
+        public = user.dict_for_public()
+        self.assertEqual(public, {'id': 1, 'tags': ['a'], 'token': {'secret': 'abc'}, 'count': 1})
+        computed = len(calls)
+        self.assertEqual(user.dict_for_public(), public)
+        self.assertEqual(len(calls), computed)
+
+        # results are copies
+        public['tags'].append('b')
+        public['token']['secret'] = 'xyz'
+        self.assertEqual(user.dict_for_public()['tags'], ['a'])
+        self.assertEqual(user.dict_for_public()['token'], {'secret': 'abc'})
+        self.assertEqual(len(calls), computed)
+
+        # json_compliant is cached separately
+        user.dict_for_public(True)
+        self.assertTrue(len(calls) > computed)
+
+        user.tags.append('b')
+        self.assertEqual(user.dict_for_public()['count'], 2)
+        user.token.secret = 'ghi'
+        self.assertEqual(user.dict_for_public()['token'], {'secret': 'ghi'})
+        user.tokens[0].secret = 'jkl'
+        self.assertEqual(user.dict_for_save()['tokens'], [{'secret': 'jkl'}])
+        user.id = 2
+        self.assertEqual(user.dict_for_save()['id'], 2)
+
+    def test_content_hash(self):
+        class Token(dico.Document):
+            secret = dico.StringField()
+            public_fields = ['secret']
+
+        class User(dico.Document):
+            id = dico.IntegerField()
+            name = dico.StringField()
+            tags = dico.ListField(dico.StringField())
+            token = dico.EmbeddedDocumentField(Token)
+            tokens = dico.ListField(dico.EmbeddedDocumentField(Token))
+            public_fields = ['name', 'tags', 'token', 'tokens']
+
+        raw = {'id': 1, 'name': 'Bob', 'tags': ['a'], 'token': {'secret': 'abc'},
+               'tokens': [{'secret': 'def'}]}
+        user = User(**raw)
+        etag = user.content_hash()
+        self.assertEqual(etag, user.content_hash())
+        self.assertEqual(etag, User(**dict(raw, name=u'Bob')).content_hash())
+        self.assertNotEqual(etag, user.content_hash('save'))
+
+        # id is not public
+        user.id = 2
+        self.assertEqual(user.content_hash(), etag)
+
+        # only the changed field is hashed again
+        name_digests = user._extras.cache['name']
+        user.tags.append('b')
+        self.assertIs(user._extras.cache['name'], name_digests)
+        tags_etag = user.content_hash()
+        self.assertNotEqual(tags_etag, etag)
+        user.tags.pop()
+        self.assertEqual(user.content_hash(), etag)
+
+        user.token.secret = 'xyz'
+        self.assertNotEqual(user.content_hash(), etag)
+        user.token.secret = 'abc'
+        self.assertEqual(user.content_hash(), etag)
+        user.tokens[0].secret = 'xyz'
+        self.assertNotEqual(user.content_hash(), etag)
+
+    def test_identity_map(self):
+        class User(dico.Document):
+            id = dico.mongo.ObjectIdField(required=True, db_name='_id')
+            name = dico.StringField()
+
+        ids = [ObjectId() for i in range(4)]
+        with dico.mongo.IdentityMap(max_size=2) as identity_map:
+            user = identity_map.load(User, {'_id': ids[0], 'name': 'Bob'})
+            self.assertEqual(user.id, ids[0])
+            self.assertIs(identity_map.load(User, {'_id': ids[0], 'name': 'Other'}), user)
+            self.assertEqual(user.name, 'Bob')
+            self.assertEqual(identity_map.stats(),
+                {'size': 1, 'hits': 1, 'misses': 1, 'evictions': 0})
+
+            # the least recently used clean document is evicted
+            identity_map.load(User, {'_id': ids[1]})
+            identity_map.get(User, ids[0])
+            identity_map.load(User, {'_id': ids[2]})
+            self.assertIn((User, ids[0]), identity_map)
+            self.assertNotIn((User, ids[1]), identity_map)
+            self.assertEqual(identity_map.evictions, 1)
+
+            # modified documents are kept
+            user.name = 'Sponge'
+            identity_map.get(User, ids[2]).name = 'Patrick'
+            identity_map.load(User, {'_id': ids[3]})
+            self.assertEqual(len(identity_map), 3)
+            self.assertEqual(len(identity_map.dirty()), 2)
+            self.assertIs(identity_map.get(User, ids[0]), user)
+
+            # a modified document is not replaced silently
+            self.assertRaises(ValueError, identity_map.add, User(id=ids[0]), ids[0])
+            self.assertIs(identity_map.get(User, ids[0]), user)
+            self.assertIs(identity_map.add(user, ids[0]), user)
+            identity_map.discard(User, ids[0])
+            self.assertIsNone(identity_map.get(User, ids[0]))
+        self.assertEqual(len(identity_map), 0)
+
+    def test_cheap_class_definition(self):
+        regex = dico.LazyRegex(r'^a+$', re.IGNORECASE)
+        self.assertIsNone(regex._compiled)
+        self.assertTrue(regex.match('AAA'))
+        self.assertEqual(regex.pattern, r'^a+$')
+        self.assertFalse(dico.URLField()._validate('not an url'))
+
+        class User(dico.Document):
+            id = dico.IntegerField(aliases=['_id'])
+            name = dico.StringField(db_name='n')
+
+        class Admin(User):
+            def is_admin(self):
+                return True
+
+        class Bot(User):
+            name = dico.IntegerField()
+            version = dico.IntegerField()
+
+        self.assertIs(Admin._fields, User._fields)
+        self.assertIs(Admin._field_bits, User._field_bits)
+        admin = Admin(_id=1, n='Bob')
+        self.assertEqual(admin.dict_for_save(), {'id': 1, 'n': 'Bob'})
+
+        self.assertEqual(sorted(Bot._fields), ['id', 'name', 'version'])
+        self.assertIsInstance(Bot._fields['name'], dico.IntegerField)
+        self.assertEqual(Bot._aliases, [('_id', 'id')])
+        self.assertEqual(Bot._db_names, {})
+
+    def test_discriminator(self):
+        class Attachment(dico.Document):
+            name = dico.StringField()
+
+        class Event(dico.Document):
+            kind = dico.StringField(db_name='_cls')
+            date = dico.DateTimeField()
+            discriminator = 'kind'
+
+        class Click(Event):
+            url = dico.URLField()
+
+        class Upload(Event):
+            attachment = dico.EmbeddedDocumentField(Attachment)
+            discriminator_value = 'upload'
+
+        class Timeline(dico.Document):
+            first = dico.EmbeddedDocumentField(Event)
+            events = dico.ListField(dico.EmbeddedDocumentField(Event))
+
+        self.assertEqual(Event._registry, {'Event': Event, 'Click': Click, 'upload': Upload})
+        click = Event.from_dict({'_cls': 'Click', 'url': 'http://example.com'})
+        self.assertIsInstance(click, Click)
+        self.assertIsInstance(Event.from_dict({}), Event)
+        self.assertRaises(ValueError, Event.from_dict, {'kind': 'Unknown'})
+        self.assertRaises(ValueError, Click.from_dict, {'kind': 'upload'})
+
+        # the value is set on creation and saved
+        upload = Upload(attachment={'name': 'a.png'})
+        self.assertEqual(upload.dict_for_save(),
+            {'_cls': 'upload', 'attachment': {'name': 'a.png'}})
+        self.assertEqual(upload.modified_fields(), set())
+
+        timeline = Timeline(first=upload.dict_for_save(),
+            events=[{'kind': 'Click'}, {'_cls': 'upload', 'attachment': {'name': 'b'}}])
+        self.assertIsInstance(timeline.first, Upload)
+        self.assertEqual([event.__class__ for event in timeline.events], [Click, Upload])
+        self.assertIs(timeline.events[1]._parent, timeline)
+
+        timeline = Timeline.from_json(
+            '{"events": [{"attachment": {"name": "c"}, "_cls": "upload"}]}')
+        self.assertIsInstance(timeline.events[0], Upload)
+        self.assertIsInstance(timeline.events[0].attachment, Attachment)
+
+        # a schema error is raised at once, not after reading the whole stream
+        from io import BytesIO
+        stream = BytesIO(b'[{"kind": "Unknown"}, ' + b', '.join([b'{"kind": "Click"}'] * 100) + b']')
+        events = Event.iter_json(stream, chunk_size=32)
+        with self.assertRaises(ValueError) as context:
+            list(events)
+        self.assertIn('Unknown', str(context.exception))
+        self.assertLess(stream.tell(), 64)
+
+        self.assertRaises(AttributeError, type, 'Bad', (dico.Document,),
+            {'discriminator': 'missing'})
+        self.assertRaises(AttributeError, type, 'Download', (Event,),
+            {'discriminator_value': 'upload'})
+        self.assertRaises(AttributeError, type, 'Click', (Event,), {})
+        self.assertIs(Event._registry['upload'], Upload)
+
+    def test_propagation_stops_at_marked_parent(self):
+        notified = []
+
+        class CountingField(dico.EmbeddedDocumentField):
+            def _child_changed(self, instance, child):
+                notified.append(instance)
+                super(CountingField, self)._child_changed(instance, child)
+
+        class Leaf(dico.Document):
+            values = dico.ListField(dico.IntegerField())
+
+        class Branch(dico.Document):
+            leaves = dico.ListField(dico.EmbeddedDocumentField(Leaf))
+
+        class Trunk(dico.Document):
+            branch = dico.EmbeddedDocumentField(Branch)
+
+        class Root(dico.Document):
+            trunk = CountingField(Trunk)
+            public_fields = ['trunk']
+            cache_dicts = True
+
+        Trunk.public_fields = ['branch']
+        Branch.public_fields = ['leaves']
+        Leaf.public_fields = ['values']
+
+        root = Root(trunk={'branch': {'leaves': [{'values': [1]}, {'values': [2]}]}})
+        self.assertTrue(root.validate())
+        leaves = root.trunk.branch.leaves
+        for i in range(100):
+            leaves[0].values.append(i)
+            leaves[1].values.append(i)
+        self.assertEqual(len(notified), 1)
+        self.assertEqual(root.modified_fields(), set(['trunk']))
+
+        # reading from the root makes the next change propagate again
+        self.assertTrue(root.validate())
+        leaves[1].values.append(-1)
+        self.assertEqual(len(notified), 2)
+        self.assertFalse(root._state & dico._VALID)
+        self.assertEqual(root.dict_for_public()['trunk']['branch']['leaves'][1]['values'][-1], -1)
+        leaves[1].values.append(-2)
+        self.assertEqual(root.dict_for_public()['trunk']['branch']['leaves'][1]['values'][-1], -2)
+        etag = root.content_hash()
+        leaves[0].values.append(-3)
+        self.assertNotEqual(root.content_hash(), etag)
+
+        # an invalid entry is still found by the list validation
+        leaves[0].values.append('bad')
+        leaves[0].values.append(4)
+        self.assertFalse(root.validate())
+        leaves[0].values.remove('bad')
+        self.assertTrue(root.validate())
+
+        # a leaf moved to another document notifies its new parents
+        other = Root(trunk={'branch': {}})
+        other.validate()
+        other.trunk.branch.leaves.append(leaves[0])
+        self.assertEqual(notified[-1], other)
+        other.validate()
+        count = len(notified)
+        leaves[0].values.append(5)
+        self.assertEqual(notified[count:], [other])
+
+    def test_coerce(self):
+        class Query(dico.Document):
+            count = dico.IntegerField()
+            ratio = dico.FloatField()
+            since = dico.DateTimeField()
+            user_id = dico.mongo.ObjectIdField()
+            ids = dico.ListField(dico.IntegerField(), typed=True)
+            name = dico.StringField()
+            coerce = True
+
+        user_id = ObjectId()
+        query = Query(count='12', ratio='0.5', since='2012-07-17T10:20:30.123Z',
+            user_id=str(user_id), ids=['1', '2'], name='12')
+        self.assertTrue(query.validate())
+        self.assertEqual(query.count, 12)
+        self.assertEqual(query.ratio, 0.5)
+        self.assertEqual(query.since, datetime.datetime(2012, 7, 17, 10, 20, 30, 123000))
+        self.assertEqual(query.user_id, user_id)
+        self.assertEqual(list(query.ids), [1, 2])
+        self.assertEqual(query.name, '12')
+
+        query.since = '2012-07-17T12:00:00+02:00'
+        self.assertEqual(query.since, datetime.datetime(2012, 7, 17, 10))
+        query.since = '2012-07-17'
+        self.assertEqual(query.since, datetime.datetime(2012, 7, 17))
+
+        # invalid strings are kept and rejected by validation
+        query.count = 'twelve'
+        query.since = '2012-13-45'
+        self.assertEqual(query.invalid_fields(), ['count', 'since'])
+
+        class PartialQuery(dico.Document):
+            count = dico.IntegerField()
+            limit = dico.IntegerField()
+            coerce = ['count']
+
+        query = PartialQuery(count='1', limit='2')
+        self.assertEqual((query.count, query.limit), (1, '2'))
+        self.assertRaises(AttributeError, type, 'Bad', (dico.Document,), {'coerce': ['missing']})
+
+    def test_store(self):
+        class City(dico.Document):
+            name = dico.StringField()
+            population = dico.IntegerField()
+
+        class Country(dico.Document):
+            id = dico.mongo.ObjectIdField(db_name='_id')
+            code = dico.StringField()
+            name = dico.StringField()
+            updated = dico.DateTimeField()
+            area = dico.FloatField()
+            capital = dico.EmbeddedDocumentField(City)
+            cities = dico.ListField(dico.EmbeddedDocumentField(City))
+            codes = dico.ListField(dico.IntegerField(), typed=True)
+
+        updated = datetime.datetime(2012, 7, 17, 10, 20, 30, 5)
+        countries = [Country(id=ObjectId(), code=code, name=name, updated=updated,
+                             area=1.5, capital={'name': name + ' city', 'population': 1},
+                             cities=[{'name': u'\xe9'}], codes=[1, 2])
+                     for code, name in [('FR', 'France'), ('ES', 'Spain'), ('IT', 'Italy')]]
+        path = os.path.join(tempfile.mkdtemp(), 'countries.dico')
+        dico.store.write(path, countries, key='code')
+
+        with dico.store.Store(Country, path) as store:
+            self.assertEqual(len(store), 3)
+            spain = store.get('ES')
+            self.assertEqual(spain.dict_for_save(), countries[1].dict_for_save())
+            self.assertEqual(spain.updated, updated)
+            self.assertEqual(spain.modified_fields(), set())
+            self.assertEqual(store[-1].name, 'Italy')
+            self.assertIsNone(store.get('DE'))
+            self.assertRaises(IndexError, lambda: store[3])
+            self.assertEqual([country.code for country in store], ['FR', 'ES', 'IT'])
+            self.assertEqual(store.keys(), ['FR', 'ES', 'IT'])
+
+        dico.store.write(path, countries, key='id')
+        with dico.store.Store(Country, path) as store:
+            self.assertEqual(store.get(countries[2].id).name, 'Italy')
+
+        # keys of different lengths, looked up in the sorted key table
+        cities = [City(name=name, population=population) for name, population in
+                  [('Rome', 3), ('Paris', 10), ('Nice', 1), ('Lyon', 200), ('Oslo', -4)]]
+        dico.store.write(path, cities, key='population')
+        with dico.store.Store(City, path) as store:
+            self.assertEqual(store.keys(), [3, 10, 1, 200, -4])
+            for city in cities:
+                self.assertEqual(store.get(city.population).name, city.name)
+            for missing in [0, 2, 5, 1000, -5, 'Rome']:
+                self.assertIsNone(store.get(missing))
+        dico.store.write(path, cities)
+        with dico.store.Store(City, path) as store:
+            self.assertEqual(store.keys(), [])
+            self.assertIsNone(store.get(3))
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+
+    def test_document_set(self):
+        from dico.documentset import DocumentSet
+        import dico.query
+
+        class User(dico.Document):
+            name = dico.StringField()
+            age = dico.IntegerField()
+            tags = dico.ListField(dico.StringField())
+            friends = dico.ListField(dico.EmbeddedDocumentField(CheckedUser))
+
+        bob = User(name='Bob', age=30, tags=['a', 'b'])
+        alice = User(name='Alice', age=20, tags=['b'])
+        eve = User(name='Eve')
+        users = DocumentSet(User, [bob, alice, eve], hash_indexes=['name', 'tags'],
+            sorted_indexes=['age'])
+        self.assertEqual(len(users), 3)
+        self.assertEqual(users.find('name', 'Bob'), [bob])
+        self.assertEqual(set(users.find('tags', 'b')), set([bob, alice]))
+        self.assertEqual(users.range('age'), [alice, bob])
+        self.assertEqual(users.range('age', 20, 30), [alice])
+        self.assertEqual(users.range('age', 20, 30, include_low=False, include_high=True), [bob])
+
+        # indexes follow assignments and list mutations
+        bob.name = 'Robert'
+        alice.tags.append('c')
+        bob.tags.remove('b')
+        eve.age = 25
+        self.assertEqual(users.find('name', 'Bob'), [])
+        self.assertEqual(users.find('name', 'Robert'), [bob])
+        self.assertEqual(users.find('tags', 'b'), [alice])
+        self.assertEqual(users.find('tags', 'c'), [alice])
+        self.assertEqual(users.range('age'), [alice, eve, bob])
+
+        # not indexed fields are scanned
+        users.add_index('age')
+        self.assertEqual(users.find('age', 25), [eve])
+        users.add_index('name')
+        users.add_index('tags', sorted=False)
+        self.assertEqual(users.find('name', 'Eve'), [eve])
+        self.assertRaises(AttributeError, users.add_index, 'friends')
+        self.assertRaises(AttributeError, users.add_index, 'name', sorted=True)
+
+        users.discard(bob)
+        self.assertIsNone(bob._extras.watchers)
+        bob.age = 1
+        self.assertEqual(users.range('age'), [alice, eve])
+        self.assertNotIn(bob, users)
+        self.assertRaises(TypeError, users.add, CheckedUser())
+
+        # without document_class a sorted list returns a document once
+        tagged = DocumentSet(sorted_indexes=['tags'],
+                             documents=[User(tags=['c', 'a', 'b']), User(tags=['b'])])
+        self.assertEqual([user.tags for user in tagged.range('tags', 'b')], [['c', 'a', 'b'], ['b']])
+        self.assertEqual([user.tags for user in tagged.range('tags')], [['c', 'a', 'b'], ['b']])
+        self.assertEqual(len(dico.query.find(tagged, {'tags': {'$gte': 'a'}})), 2)
+
+    def test_query(self):
+        from dico.documentset import DocumentSet
+        import dico.query
+
+        class Address(dico.Document):
+            city = dico.StringField()
+            zip = dico.IntegerField()
+
+        class User(dico.Document):
+            name = dico.StringField()
+            age = dico.IntegerField()
+            tags = dico.ListField(dico.StringField())
+            address = dico.EmbeddedDocumentField(Address)
+            addresses = dico.ListField(dico.EmbeddedDocumentField(Address))
+
+        bob = User(name='Bob', age=30, tags=['admin', 'dev'], address={'city': 'Paris', 'zip': 75},
+                   addresses=[{'city': 'Lyon', 'zip': 69}, {'city': 'Nice', 'zip': 6}])
+        alice = User(name='Alice', age=20, tags=['dev'], address={'city': 'Lyon', 'zip': 69})
+        eve = User(name='Eve', tags=[])
+        users = [bob, alice, eve]
+
+        def names(spec):
+            return sorted(user.name for user in dico.query.find(users, spec, User))
+
+        self.assertEqual(names({'age': {'$gt': 25}}), ['Bob'])
+        self.assertEqual(names({'age': {'$gte': 20, '$lt': 30}}), ['Alice'])
+        self.assertEqual(names({'age': {'$gt': 'a'}}), [])
+        self.assertEqual(names({'tags': 'dev'}), ['Alice', 'Bob'])
+        self.assertEqual(names({'tags': ['dev']}), ['Alice'])
+        self.assertEqual(names({'tags': {'$in': ['admin', 'other']}}), ['Bob'])
+        self.assertEqual(names({'tags': {'$nin': ['admin']}}), ['Alice', 'Eve'])
+        self.assertEqual(names({'tags': {'$all': ['admin', 'dev']}}), ['Bob'])
+        self.assertEqual(names({'tags': {'$size': 0}}), ['Eve'])
+        self.assertEqual(names({'age': None}), ['Eve'])
+        self.assertEqual(names({'age': {'$exists': True}, 'name': {'$ne': 'Bob'}}), ['Alice'])
+        self.assertEqual(names({'name': {'$regex': '^b', '$options': 'i'}}), ['Bob'])
+        self.assertEqual(names({'name': re.compile('e$')}), ['Alice', 'Eve'])
+        self.assertEqual(names({'address.city': 'Lyon'}), ['Alice'])
+        self.assertEqual(names({'address': {'city': 'Lyon', 'zip': 69}}), ['Alice'])
+        self.assertEqual(names({'addresses.city': 'Nice'}), ['Bob'])
+        self.assertEqual(names({'addresses.0.zip': 69}), ['Bob'])
+        self.assertEqual(names({'addresses': {'$elemMatch': {'city': 'Nice', 'zip': {'$lt': 10}}}}),
+                         ['Bob'])
+        self.assertEqual(names({'age': {'$not': {'$gt': 25}}}), ['Alice', 'Eve'])
+        self.assertEqual(names({'$or': [{'age': 20}, {'name': 'Eve'}]}), ['Alice', 'Eve'])
+        self.assertEqual(names({'$nor': [{'age': 20}, {'name': 'Eve'}]}), ['Bob'])
+        self.assertRaises(AttributeError, dico.query.compile, {'address.country': 'FR'}, User)
+        self.assertRaises(ValueError, dico.query.compile, {'age': {'$near': 1}}, User)
+
+        # indexes give the candidates
+        document_set = DocumentSet(User, users, hash_indexes=['tags'], sorted_indexes=['age'])
+        self.assertEqual(dico.query._candidates(document_set, {'tags': 'admin', 'age': {'$lte': 30}}),
+                         [bob])
+        self.assertEqual(dico.query.find(document_set, {'tags': 'admin', 'age': {'$lte': 30}}), [bob])
+        self.assertEqual(dico.query.find(document_set, {'age': {'$gt': 20, '$lte': 30}}), [bob])
+        self.assertEqual(dico.query.find(document_set, {'tags': {'$in': ['dev']}, 'name': 'Alice'}),
+                         [alice])
+        alice.tags.append('admin')
+        self.assertEqual(len(dico.query.find(document_set, {'tags': 'admin'})), 2)
+
+        # bounds of another kind than the indexed values match nothing
+        class Event(dico.Document):
+            when = dico.DateTimeField()
+
+        events = DocumentSet(Event, [Event(when=datetime.datetime(2012, 7, 17))],
+                             sorted_indexes=['when'])
+        self.assertEqual(dico.query.find(events, {'when': {'$gt': 5}}), [])
+        self.assertEqual(dico.query.find(document_set, {'age': {'$gt': 'a'}}), [])
+        self.assertEqual(len(dico.query.find(events, {'when': {'$gt': datetime.datetime(2012, 1, 1)}})), 1)
+
+    def test_change_observer(self):
+        from dico.events import ChangeObserver
+
+        class Address(dico.Document):
+            city = dico.StringField()
+
+        class User(dico.Document):
+            name = dico.StringField()
+            tags = dico.ListField(dico.StringField())
+            address = dico.EmbeddedDocumentField(Address)
+
+        class Admin(User):
+            pass
+
+        received = []
+        observer = ChangeObserver(lambda document, fields: received.append((document, fields)))
+        observer.subscribe(User)
+        bob = User(name='Bob', address={'city': 'Paris'})
+        admin = Admin(name='Root')
+        other = Address(city='Lyon')
+        observer.subscribe(other)
+
+        bob.name = 'Robert'
+        bob.tags.append('a')
+        bob.tags.append('b')
+        bob.address.city = 'Nice'
+        admin.name = 'Admin'
+        other.city = 'Nice'
+        self.assertEqual(observer.pending(), 3)
+        self.assertEqual(observer.flush(), [
+            (bob, frozenset(['name', 'tags', 'address'])),
+            (admin, frozenset(['name'])),
+            (other, frozenset(['city']))])
+        self.assertEqual(len(received), 3)
+        self.assertEqual(observer.flush(), [])
+
+        # changes in embedded documents reach the parent after a flush
+        bob.address.city = 'Paris'
+        self.assertEqual(observer.flush(), [(bob, frozenset(['address']))])
+
+        observer.unsubscribe(User)
+        observer.unsubscribe(other)
+        bob.name = 'Bob'
+        other.city = 'Lyon'
+        self.assertEqual(observer.flush(), [])
+        self.assertRaises(TypeError, observer.subscribe, object())
+
+        # embedded documents changed before the subscription
+        bob.address.city = 'Brest'
+        observer.subscribe(bob)
+        bob.address.city = 'Nantes'
+        self.assertEqual(observer.flush(), [(bob, frozenset(['address']))])
+        observer.unsubscribe(bob)
+
+        alice = User(name='Alice', address={'city': 'Lyon'})
+        alice.address.city = 'Brest'
+        observer.subscribe(User)
+        alice.address.city = 'Nantes'
+        self.assertEqual(observer.flush(), [(alice, frozenset(['address']))])
+
+        # the changes of documents without watched parents still stop early
+        notified = []
+
+        class CountingField(dico.EmbeddedDocumentField):
+            def _child_changed(self, instance, child):
+                notified.append(instance)
+                super(CountingField, self)._child_changed(instance, child)
+
+        class Place(dico.Document):
+            address = CountingField(Address)
+
+        place = Place(address={'city': 'Lyon'})
+        for city in ['Brest', 'Nantes', 'Paris']:
+            place.address.city = city
+        self.assertEqual(notified, [place])
+        observer.unsubscribe(User)
+        self.assertFalse(dico._watched_classes)
+
+    def test_mark_clean_and_rollback(self):
+        class Address(dico.Document):
+            city = dico.StringField()
+
+        class User(dico.Document):
+            name = dico.StringField()
+            age = dico.IntegerField()
+            tags = dico.ListField(dico.StringField())
+            address = dico.EmbeddedDocumentField(Address)
+            addresses = dico.ListField(dico.EmbeddedDocumentField(Address))
+            track_snapshot = True
+
+        user = User(name='Bob', age=30, tags=['a'], address={'city': 'Paris'},
+                    addresses=[{'city': 'Lyon'}])
+        user.name = 'Robert'
+        user.addresses[0].city = 'Nice'
+        self.assertEqual(user.modified_fields(), set(['name', 'addresses']))
+        user.mark_clean()
+        self.assertEqual(user.modified_fields(), set())
+        self.assertEqual(user.addresses[0].modified_fields(), set())
+        user.name = 'Bob'
+        self.assertEqual(user.modified_fields(), set(['name']))
+        user.name = 'Robert'
+        self.assertEqual(user.modified_fields(), set())
+
+        # changes of embedded documents still reach the parent after mark_clean
+        user.address.city = 'Lille'
+        self.assertEqual(user.modified_fields(), set(['address']))
+
+        user.savepoint()
+        user.age = 31
+        user.tags.append('b')
+        user.address.city = 'Nantes'
+        user.addresses[0].city = 'Brest'
+        user.rollback()
+        self.assertEqual(user.age, 30)
+        self.assertEqual(user.tags, ['a'])
+        self.assertEqual(user.address.city, 'Lille')
+        self.assertIs(user.address._parent, user)
+        self.assertEqual(user.addresses[0].city, 'Nice')
+        self.assertEqual(user.modified_fields(), set(['address']))
+        self.assertTrue(user.validate())
+        self.assertRaises(ValueError, user.rollback)
+
+        user.tags.append('c')
+        self.assertEqual(user.tags, ['a', 'c'])
+        self.assertEqual(user.modified_fields(), set(['address', 'tags']))
+
+        # embedded documents are restored in place with their modified state
+        address, first = user.address, user.addresses[0]
+        user.savepoint()
+        address.city = 'Rennes'
+        first.city = 'Metz'
+        user.addresses.append(Address(city='Pau'))
+        user.address = Address(city='Caen')
+        user.rollback()
+        self.assertIs(user.address, address)
+        self.assertEqual(address.city, 'Lille')
+        self.assertEqual(address.modified_fields(), set(['city']))
+        self.assertEqual(user.addresses, [first])
+        self.assertEqual(first.city, 'Nice')
+        self.assertEqual(first.modified_fields(), set())
+        self.assertEqual(user.modified_fields(), set(['address', 'tags']))
+        first.city = 'Metz'
+        self.assertEqual(user.modified_fields(), set(['address', 'tags', 'addresses']))
+
+        class Point(dico.Document):
+            position = dico.BaseField()
+
+        point = Point(position=(1, 2))
+        point.savepoint()
+        point.position = [3]
+        point.rollback()
+        self.assertEqual(point.position, (1, 2))
+
+    def test_clone(self):
+        class Address(dico.Document):
+            city = dico.StringField()
+
+        class User(dico.Document):
+            name = dico.StringField()
+            tags = dico.ListField(dico.StringField())
+            address = dico.EmbeddedDocumentField(Address)
+            addresses = dico.ListField(dico.EmbeddedDocumentField(Address))
+
+        user = User(name='Bob', tags=['a'], address={'city': 'Paris'},
+                    addresses=[{'city': 'Lyon'}])
+        user.validate()
+        user.name = 'Robert'
+        clone = user.clone()
+        other = user.clone()
+        self.assertIs(clone._extras.shared['tags'], other._extras.shared['tags'])
+        self.assertEqual(clone.modified_fields(), set(['name']))
+        self.assertEqual(clone.dict_for_save(), user.dict_for_save())
+
+        # changes of the clone stay in the clone
+        clone.tags.append('b')
+        clone.address.city = 'Lille'
+        self.assertIs(clone.address._parent, clone)
+        self.assertEqual(user.tags, ['a'])
+        self.assertEqual(user.address.city, 'Paris')
+        self.assertEqual(clone.modified_fields(), set(['name', 'tags', 'address']))
+        self.assertEqual(clone.address.modified_fields(), set(['city']))
+
+        # changes of the document do not reach the clones
+        user.addresses[0].city = 'Nice'
+        user.tags.append('c')
+        self.assertEqual(other.addresses[0].city, 'Lyon')
+        self.assertEqual(other.tags, ['a'])
+        self.assertEqual(other.modified_fields(), set(['name']))
+        self.assertEqual(other.addresses[0].modified_fields(), set())
+        self.assertEqual(clone.tags, ['a', 'b'])
+        self.assertEqual(user.modified_fields(), set(['name', 'tags', 'addresses']))
+        holder = other._extras.shared['address']
+        self.assertIn(holder, user._extras.watchers)
+        user.address.city = 'Nantes'
+        self.assertEqual(other.address.city, 'Paris')
+        # nothing left to share, the document is not watched anymore
+        self.assertIsNone(user._extras.watchers)
+
+        third = user.clone()
+        self.assertIsNot(third._extras.shared['address'], holder)
+        self.assertEqual(third.addresses[0].city, 'Nice')
+
+        # clones of clones read the values not read yet by their document
+        user = User(name='Bob', tags=['a'], address={'city': 'Paris'})
+        clone = user.clone()
+        grandchild = clone.clone()
+        self.assertEqual(grandchild.tags, ['a'])
+        self.assertEqual(grandchild.address.city, 'Paris')
+        self.assertIs(grandchild.address._parent, grandchild)
+        clone = user.clone()
+        clone.tags.append('b')
+        grandchild = clone.clone()
+        user.address.city = 'Lyon'
+        clone.tags.append('c')
+        self.assertEqual(grandchild.address.city, 'Paris')
+        self.assertEqual(grandchild.tags, ['a', 'b'])
+
+        class Tracked(User):
+            track_snapshot = True
+
+        tracked = Tracked(name='Bob', tags=['a'])
+        clone = tracked.clone()
+        clone.name = 'Robert'
+        clone.mark_clean()
+        tracked.tags.append('b')
+        self.assertEqual(clone.modified_fields(), set())
+        clone.tags.append('b')
+        self.assertEqual(clone.modified_fields(), set(['tags']))
+        self.assertEqual(clone.clone().clone().tags, ['a', 'b'])
+
+        # a holder done with the document does not hide the next watcher
+        user = User(tags=['a'], addresses=[{'city': 'Lyon'}])
+        first = user.clone()
+        user.addresses.append(Address(city='Nice'))
+        second = user.clone()
+        user.tags.append('b')
+        self.assertEqual(first.tags, ['a'])
+        self.assertEqual(second.tags, ['a'])
+
+        # changes deep in a shared value do not reach the clones
+        class Country(dico.Document):
+            address = dico.EmbeddedDocumentField(User)
+            grid = dico.ListField(dico.ListField(dico.IntegerField()))
+
+        country = Country(address={'tags': ['a'], 'address': {'city': 'Paris'},
+                                   'addresses': [{'city': 'Lyon'}]}, grid=[[1]])
+        clone = country.clone()
+        country.address.tags.append('b')
+        country.address.address.city = 'Nice'
+        country.address.addresses[0].city = 'Brest'
+        country.grid[0].append(2)
+        self.assertEqual(clone.address.tags, ['a'])
+        self.assertEqual(clone.address.address.city, 'Paris')
+        self.assertEqual(clone.address.addresses[0].city, 'Lyon')
+        self.assertEqual(clone.grid, [[1]])
+        self.assertIs(clone.address.address._parent, clone.address)
+        self.assertEqual(clone.modified_fields(), set())
+        self.assertEqual(clone.address.address.modified_fields(), set())
+        clone.address.address.city = 'Lille'
+        self.assertEqual(clone.modified_fields(), set(['address']))
+        self.assertEqual(country.address.address.city, 'Nice')
+
+    def test_computed(self):
+        calls = []
+
+        class Address(dico.Document):
+            city = dico.StringField()
+
+        class User(dico.Document):
+            firstname = dico.StringField()
+            name = dico.StringField()
+            age = dico.IntegerField()
+            scores = dico.ListField(dico.IntegerField())
+            address = dico.EmbeddedDocumentField(Address)
+            public_fields = ['name', 'full_name', 'total', 'location']
+
+            @dico.computed('firstname', 'name')
+            def full_name(self):
+                calls.append('full_name')
+                return self.firstname + ' ' + self.name
+
+            @dico.computed('scores')
+            def total(self):
+                calls.append('total')
+                return sum(self.scores)
+
+            @dico.computed('address')
+            def location(self):
+                calls.append('location')
+                return self.address.city.upper()
+
+        user = User(firstname='Bob', name='Sponge', scores=[1, 2], address={'city': 'Paris'})
+        self.assertEqual(user.dict_for_public()['full_name'], 'Bob Sponge')
+        user.dict_for_public()
+        self.assertEqual(sorted(calls), ['full_name', 'location', 'total'])
+
+        # only the properties depending on a changed field are computed again
+        del calls[:]
+        user.age = 3
+        user.scores.append(3)
+        self.assertEqual(user.dict_for_public()['total'], 6)
+        self.assertEqual(calls, ['total'])
+
+        del calls[:]
+        user.address.city = 'Lyon'
+        self.assertEqual(user.location, 'LYON')
+        user.address.city = 'Nice'
+        self.assertEqual(user.location, 'NICE')
+        self.assertEqual(calls, ['location', 'location'])
+
+        self.assertRaises(AttributeError, setattr, user, 'total', 1)
+
+        class Broken(dico.Document):
+            name = dico.StringField()
+
+            @dico.computed('nickname')
+            def label(self):
+                return self.name
+
+        self.assertRaises(AttributeError, getattr, Broken(name='a'), 'label')
+
+    def test_migrations(self):
+        calls = []
+
+        def split_name(values):
+            calls.append(0)
+            firstname, _, name = values.pop('fullname', '').partition(' ')
+            values['firstname'], values['name'] = firstname, name
+            return values
+
+        def add_country(values):
+            calls.append(1)
+            values.setdefault('country', 'FR')
+            return values
+
+        class User(dico.Document):
+            id = dico.IntegerField(db_name='_id')
+            version = dico.IntegerField()
+            firstname = dico.StringField()
+            name = dico.StringField()
+            country = dico.StringField()
+            schema_version = 2
+            schema_version_field = 'version'
+            migrations = {0: split_name, 1: add_country}
+            track_snapshot = True
+
+        user = User(_id=1, version=0, fullname='Bob Sponge')
+        self.assertEqual(calls, [0, 1])
+        self.assertEqual((user.firstname, user.name, user.country), ('Bob', 'Sponge', 'FR'))
+        self.assertEqual(user.dict_for_modified_fields(), {'version': 2, 'firstname': 'Bob',
+            'name': 'Sponge', 'country': 'FR'})
+
+        # only the missing steps run
+        del calls[:]
+        user = User(_id=1, version=1, firstname='Bob', country='US')
+        self.assertEqual(calls, [1])
+        self.assertEqual(user.country, 'US')
+        self.assertEqual(user.modified_fields(), set(['version']))
+
+        del calls[:]
+        user = User(_id=1, version=2, firstname='Bob')
+        self.assertEqual(user.modified_fields(), set())
+        user = User(firstname='Bob')
+        self.assertEqual(user.version, 2)
+        self.assertEqual(calls, [])
+
+        class Admin(User):
+            pass
+
+        self.assertEqual(Admin(version=1).country, 'FR')
+
+        # upgraded embedded documents are written back with their parent
+        def add_zip(values):
+            values['zip'] = values.get('zip') or 0
+            return values
+
+        class Address(dico.Document):
+            v = dico.IntegerField()
+            city = dico.StringField()
+            zip = dico.IntegerField()
+            schema_version = 1
+            schema_version_field = 'v'
+            migrations = {0: add_zip}
+
+        class Upload(dico.Document):
+            name = dico.StringField()
+
+        class Post(dico.Document):
+            attachment = dico.EmbeddedDocumentField(Upload)
+
+        class Person(dico.Document):
+            name = dico.StringField()
+            addr = dico.EmbeddedDocumentField(Address)
+            addrs = dico.ListField(dico.EmbeddedDocumentField(Address))
+            track_snapshot = True
+
+        person = Person(name='Bob', addr={'v': 0, 'city': 'Paris'},
+                        addrs=[{'v': 1, 'city': 'Lyon', 'zip': 69}, {'v': 0, 'city': 'Nice'}])
+        self.assertEqual(person.modified_fields(), set(['addr', 'addrs']))
+        self.assertEqual(person.addr.modified_fields(), set(['v', 'zip']))
+        self.assertEqual(sorted(person.dict_for_modified_fields()), ['addr', 'addrs'])
+        person = Person.from_json('{"addr": {"v": 0, "city": "Paris"}}')
+        self.assertEqual(person.modified_fields(), set(['addr']))
+        person = Person(name='Bob', addr={'v': 1, 'city': 'Paris'}, addrs=[{'city': 'Lyon'}])
+        self.assertEqual(person.modified_fields(), set())
+
+        # other changes of an embedded document do not mark a new parent
+        address = Address(v=1, city='Paris')
+        address.city = 'Lyon'
+        self.assertEqual(Person(addr=address).modified_fields(), set())
+        upload = Upload(name='a.png')
+        upload.name = 'b.png'
+        self.assertEqual(Post(attachment=upload).modified_fields(), set())
+
+        with self.assertRaises(AttributeError):
+            class Broken(dico.Document):
+                version = dico.IntegerField()
+                schema_version = 2
+                schema_version_field = 'version'
+                migrations = {0: split_name}
+
+    def test_aio_cursor(self):
+        class User(dico.Document):
+            id = dico.IntegerField(aliases=['_id'])
+            name = dico.StringField(required=True)
+
+        loop = dico.aio.asyncio.new_event_loop()
+        collection = dico.aio.MemoryCollection(
+            [{'_id': i, 'name': 'Bob%d' % i} for i in range(5)], loop=loop)
+
+        cursor = dico.aio.find(User, collection, batch_size=2, loop=loop)
+        first = loop.run_until_complete(cursor.fetch_next())
+        self.assertIsInstance(first, User)
+        self.assertEqual(first.id, 0)
+        users = loop.run_until_complete(cursor.to_list())
+        self.assertEqual([user.id for user in users], [1, 2, 3, 4])
+        self.assertIsNone(loop.run_until_complete(cursor.fetch_next()))
+
+        cursor = dico.aio.find(User, collection, batch_size=10, validate=True,
+            offload=True, loop=loop)
+        users = loop.run_until_complete(cursor.to_list())
+        self.assertEqual(len(users), 5)
+
+        collection.documents.append({'_id': 5})
+        cursor = dico.aio.find(User, collection, {'_id': 5}, validate=True,
+            offload=True, loop=loop)
+        self.assertRaises(dico.ValidationException, loop.run_until_complete,
+            cursor.fetch_next())
+        loop.close()
+
+    def test_aio_save_modified(self):
+        class User(dico.Document):
+            id = dico.IntegerField(aliases=['_id'])
+            name = dico.StringField()
+
+        loop = dico.aio.asyncio.new_event_loop()
+        collection = dico.aio.MemoryCollection([{'_id': 1, 'name': 'Bob'}], loop=loop)
+        user = User(_id=1, name='Bob')
+
+        result = loop.run_until_complete(
+            dico.aio.save_modified(collection, user, {'_id': user.id}, loop=loop))
+        self.assertIsNone(result)
+
+        user.name = 'Sponge'
+        result = loop.run_until_complete(dico.aio.save_modified(collection, user,
+            {'_id': user.id}, offload=True, loop=loop))
+        self.assertEqual(result, 1)
+        self.assertEqual(collection.documents[0]['name'], 'Sponge')
+
+        user.name = 3
+        self.assertRaises(dico.ValidationException, loop.run_until_complete,
+            dico.aio.save_modified(collection, user, {'_id': user.id}, loop=loop))
+
+        dicts = loop.run_until_complete(dico.aio.serialize_many(
+            [User(id=i) for i in range(3)], offload=True, loop=loop))
+        self.assertEqual(dicts, [{'id': 0}, {'id': 1}, {'id': 2}])
+        loop.close()
+
+
+    def test_aio_serialize_chunked(self):
+        class Comment(dico.Document):
+            text = dico.StringField()
+            public_fields = ['text']
+
+        class Post(dico.Document):
+            title = dico.StringField()
+            comments = dico.ListField(dico.EmbeddedDocumentField(Comment))
+            public_fields = ['title', 'comments']
+
+        post = Post(title='news', comments=[{'text': str(i)} for i in range(250)])
+        steps = list(post.iter_dict_for('public', chunk_size=100))
+        self.assertEqual(steps[:2], [None, None])
+        self.assertEqual(steps[-1], post.dict_for_public())
+        self.assertEqual(list(post.iter_dict_for(chunk_size=100))[-1], post.dict_for_save())
+
+        # a change between two chunks restarts the serialization
+        steps = post.iter_dict_for('public', chunk_size=100)
+        next(steps)
+        post.comments[0].text = 'first'
+        result = [step for step in steps if step is not None][0]
+        self.assertEqual(result['comments'][0], {'text': 'first'})
+
+        loop = dico.aio.asyncio.new_event_loop()
+        ticks = []
+
+        def tick():
+            ticks.append(len(ticks))
+            if len(ticks) < 3:
+                loop.call_soon(tick)
+
+        loop.call_soon(tick)
+        result = loop.run_until_complete(dico.aio.serialize_chunked(post, 'public',
+            chunk_size=100, budget=0, loop=loop))
+        self.assertEqual(result, post.dict_for_public())
+        # the other callbacks ran between the chunks
+        self.assertEqual(len(ticks), 3)
+
+        post.title = 3
+        self.assertRaises(dico.ValidationException, loop.run_until_complete,
+            dico.aio.serialize_chunked(post, 'save', loop=loop))
+        loop.close()
+
 
 if __name__ == "__main__":
     unittest.main()